@@ -1,19 +1,48 @@
 import sys
+import os
 import json
+import glob
+import argparse
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QTextBrowser, QAction, QFileDialog, QWidget, QMessageBox, QTextEdit,
                              QFontDialog, QColorDialog, QPushButton, QDialog, QComboBox, QLabel, QVBoxLayout, QInputDialog, 
-                             QSpinBox, QGridLayout, QLineEdit)
+                             QSpinBox, QGridLayout, QLineEdit, QProgressDialog, QProgressBar, QPlainTextEdit, QScrollBar,
+                             QListWidget, QListWidgetItem)
 from PyQt5 import uic, QtCore, QtGui
 from PyQt5.QtGui import QTextCursor, QPixmap, QKeySequence, QFont, QTextCharFormat, QColor, QTextBlockFormat, QImage, QTextDocument, QBrush, QDesktopServices
-from PyQt5.QtCore import QFileInfo, Qt, QUrl, QPoint, QRegExp, QEvent
+from PyQt5.QtGui import QPainter, QPicture, QFontMetrics, QGuiApplication, QFontDatabase, QTextImageFormat, QTextTableFormat, QTextLength
+from PyQt5.QtGui import QTextTable
+from PyQt5.QtCore import QBuffer, QIODevice, QFileInfo, Qt, QUrl, QPoint, QEvent, QObject, pyqtSignal, QPointF, QRectF, QThread, QStandardPaths, QTimer
 from PyQt5.QtPrintSupport import QPrintDialog, QPrinter, QPrintPreviewDialog
-from functools import partial
+from functools import partial, lru_cache
+from collections import OrderedDict
+from itertools import count
+from array import array
+from bisect import bisect_left
 from docx import Document
-from docx.shared import RGBColor, Pt
+from docx.shared import RGBColor, Pt, Length
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.text.paragraph import Paragraph
+from docx.text.run import Run
+from io import BytesIO
+from html import escape
+from copy import deepcopy
 import summer_practice.res_rc
 import webbrowser
 import fitz
+import tempfile
+import zlib
+import mmap
+import struct
+import hashlib
+import time
+import codecs
+import re
+import locale
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 
@@ -162,7 +191,227 @@ class StyleDialog(QDialog):
                 self.parent().saveStyles(self.styles)
 
 
+ASTRAL_CHARS = re.compile("[\U00010000-\U0010FFFF]")
+
+
+@lru_cache(maxsize=64)
+def searchPattern(text, wholeWord=False, prefix=False):
+    # Строка ищется буквально; целое слово не должно продолжаться буквами с обеих сторон, начало слова — слева
+    # \b вместо проверок соседних символов: так быстрее, но годится только у краёв, где стоит буква
+    pattern = re.escape(text)
+    if (wholeWord or prefix) and text:
+        pattern = (r"\b" if re.match(r"\w", text[0]) else r"(?<!\w)") + pattern
+    if wholeWord and text:
+        pattern += r"\b" if re.match(r"\w", text[-1]) else r"(?!\w)"
+    return re.compile(pattern)
+
+
+def astralPositions(text):
+    # Смещения Python считаются в символах, а позиции QTextDocument — в единицах UTF-16,
+    # где символ вне BMP занимает две позиции; к смещению прибавляется число таких символов до него
+    return [] if text.isascii() else [match.start() for match in ASTRAL_CHARS.finditer(text)]
+
+
+def iterMatches(text, pattern):
+    # Совпадения за один проход по снимку текста, в позициях документа
+    astral = astralPositions(text)
+    for match in pattern.finditer(text):
+        start, end = match.span()
+        if astral:
+            start, end = start + bisect_left(astral, start), end + bisect_left(astral, end)
+        yield start, end
+
+
+def findMatches(text, pattern):
+    return list(iterMatches(text, pattern))
+
+
+class SearchThread(QThread):
+    # Поиск по снимку текста в фоне; совпадения отдаются порциями, первая — сразу после первых находок
+    FIRST_BATCH = 100
+    BATCH_SIZE = 5000
+    BATCH_INTERVAL = 0.1  # с; редкие совпадения не копятся дольше
+    matchesFound = pyqtSignal(object)  # [(начало, конец)] в позициях документа
+
+    def __init__(self, text, pattern, parent=None):
+        super().__init__(parent)
+        self.text = text
+        self.pattern = pattern
+
+    def run(self):
+        batch = []
+        limit = self.FIRST_BATCH
+        sent = time.perf_counter()
+        for span in iterMatches(self.text, self.pattern):
+            batch.append(span)
+            if len(batch) >= limit or time.perf_counter() - sent >= self.BATCH_INTERVAL:
+                if self.isInterruptionRequested():
+                    return
+                self.matchesFound.emit(batch)
+                batch = []
+                limit = self.BATCH_SIZE
+                sent = time.perf_counter()
+        if batch and not self.isInterruptionRequested():
+            self.matchesFound.emit(batch)
+
+
+def spanCursors(document, spans):
+    # Курсор вне блока правки при каждом setPosition считает горизонтальную позицию по раскладке строки,
+    # что в разы медленнее самого создания курсора; внутри блока правки этот расчёт откладывается.
+    # Пустой блок правки всё равно сообщает об изменении содержимого, поэтому сигналы документа глушим
+    cursors = []
+    editBlock = QTextCursor(document)
+    editBlock.beginEditBlock()
+    try:
+        for start, end in spans:
+            cursor = QTextCursor(document)
+            cursor.setPosition(start)
+            cursor.setPosition(end, QTextCursor.KeepAnchor)
+            cursors.append(cursor)
+    finally:
+        blocked = document.blockSignals(True)
+        editBlock.endEditBlock()
+        document.blockSignals(blocked)
+    return cursors
+
+
+class MatchHighlighter(QObject):
+    # Смещения совпадений хранятся массивами вне редактора, а выделения ставятся только на совпадения
+    # в видимой области и рядом с ней и переставляются при прокрутке и изменении размера,
+    # так что цена подсветки зависит от размера экрана, а не от числа совпадений
+    FULL_LIMIT = 1000  # столько совпадений выделяются все сразу
+    MARGIN = 4096  # символов до и после видимой области
+    RESEARCH_DELAY = 300  # мс после правки до повторного поиска
+    matchCountChanged = pyqtSignal(int)  # найдено пока
+    searchFinished = pyqtSignal(int, float)  # всего совпадений, секунд
+
+    def __init__(self, textEdit, parent=None):
+        super().__init__(parent)
+        self.textEdit = textEdit
+        self.searchThread = None
+        self.started = 0
+        self.format = QTextCharFormat()
+        self.format.setBackground(QBrush(Qt.yellow))
+        self.pattern = None
+        self.document = None
+        self.starts = array('Q')
+        self.ends = array('Q')
+        self.shown = None  # (первое, после последнего) выставленные совпадения
+        self.researchTimer = QTimer(self)
+        self.researchTimer.setSingleShot(True)
+        self.researchTimer.setInterval(self.RESEARCH_DELAY)
+        self.researchTimer.timeout.connect(self.research)
+        textEdit.verticalScrollBar().valueChanged.connect(self.updateVisible)
+        textEdit.horizontalScrollBar().valueChanged.connect(self.updateVisible)
+        textEdit.viewport().installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Resize:
+            self.updateVisible()
+        return False
+
+    def search(self, pattern):
+        self.pattern = pattern
+        self.research()
+
+    def clear(self):
+        self.pattern = None
+        self.research()
+
+    def stop(self):
+        # Незавершённый поиск больше не нужен; его поток доработает сам и будет удалён
+        if self.searchThread is not None:
+            self.searchThread.requestInterruption()
+            self.searchThread = None
+
+    def research(self):
+        # Смещения после правки устаревают, поэтому текст ищется заново
+        self.stop()
+        self.researchTimer.stop()
+        if self.document is not None:
+            self.document.contentsChange.disconnect(self.onContentsChange)
+        self.document = None
+        self.starts = array('Q')
+        self.ends = array('Q')
+        self.shown = None
+        self.install([])
+        if self.pattern is None:
+            return
+        self.document = self.textEdit.document()
+        self.document.contentsChange.connect(self.onContentsChange)
+        self.started = time.perf_counter()
+        self.searchThread = SearchThread(self.document.toPlainText(), self.pattern, self)
+        self.searchThread.matchesFound.connect(self.onMatchesFound)
+        self.searchThread.finished.connect(self.onSearchFinished)
+        self.searchThread.start()
+
+    def onMatchesFound(self, spans):
+        if self.sender() is not self.searchThread:
+            return
+        self.starts.extend(start for start, _ in spans)
+        self.ends.extend(end for _, end in spans)
+        if len(self.starts) <= self.FULL_LIMIT:
+            self.install(zip(self.starts, self.ends))
+        else:
+            self.updateVisible()
+        self.matchCountChanged.emit(len(self.starts))
+
+    def onSearchFinished(self):
+        thread = self.sender()
+        thread.deleteLater()
+        if thread is self.searchThread:
+            self.searchThread = None
+            self.searchFinished.emit(len(self.starts), time.perf_counter() - self.started)
+
+    def close(self):
+        # Перед закрытием окна дожидаемся всех потоков поиска, в том числе прерванных
+        self.stop()
+        for thread in self.findChildren(SearchThread):
+            thread.wait()
+
+    def onContentsChange(self, position, removed, added):
+        self.researchTimer.start()
+
+    def documentChanged(self):
+        # В редакторе открыта другая страница: выделения старой страницы снимаются сразу, без ожидания
+        # прокрутки, а совпадения ищутся в новой
+        if self.pattern is not None and self.textEdit.document() is not self.document:
+            self.research()
+
+    def updateVisible(self):
+        self.documentChanged()
+        # Пока не прошёл повторный поиск после правки, смещения устарели, а выставленные курсоры сдвинулись сами
+        if self.pattern is None or self.researchTimer.isActive():
+            return
+        if len(self.starts) <= self.FULL_LIMIT:
+            return
+        # Точка на поле документа попадает куда угодно, поэтому верх берём ниже поля
+        viewport = self.textEdit.viewport()
+        margin = int(self.document.documentMargin())
+        top = self.textEdit.cursorForPosition(QPoint(0, margin)).position()
+        bottom = self.textEdit.cursorForPosition(QPoint(viewport.width(), viewport.height())).position()
+        top, bottom = min(top, bottom), max(top, bottom)
+        first = bisect_left(self.ends, max(0, top - self.MARGIN))
+        last = bisect_left(self.starts, bottom + self.MARGIN)
+        if (first, last) != self.shown:
+            self.shown = (first, last)
+            self.install(zip(self.starts[first:last], self.ends[first:last]))
+
+    def install(self, spans):
+        selections = []
+        for cursor in spanCursors(self.textEdit.document(), spans):
+            selection = QTextEdit.ExtraSelection()
+            selection.cursor = cursor
+            selection.format = self.format
+            selections.append(selection)
+        self.textEdit.setExtraSelections(selections)
+
+
 class FindDialog(QDialog):
+    SEARCH_DELAY = 250  # мс без нажатий до запуска поиска
+    MAX_RESULTS = 2000  # столько совпадений по всем страницам показывается списком
+    CONTEXT_CHARS = 40
+
     def __init__(self, parent):
         super().__init__()
         self.parent = parent
@@ -178,72 +427,139 @@ class FindDialog(QDialog):
         layout.addWidget(self.findButton)
 
         self.comboBox = QComboBox()
-        self.comboBox.addItems(["Select full word", "Select piece"])
+        self.comboBox.addItems(["Select full word", "Select piece", "Select word start"])
         layout.addWidget(self.comboBox)
 
+        self.statusLabel = QLabel()
+        layout.addWidget(self.statusLabel)
+
+        self.findAllButton = QPushButton("Find in all pages")
+        layout.addWidget(self.findAllButton)
+
+        self.resultsList = QListWidget()
+        self.resultsList.hide()
+        layout.addWidget(self.resultsList, layout.rowCount(), 0, 1, 2)
+
         self.setLayout(layout)
 
-        self.extraSelections = []
-        self.changed = False
         self.isFullWord = True
+        self.isPrefix = False
 
         self.setWhatsThis("Whats this")
         self.setWindowFlags(Qt.WindowContextHelpButtonHint | Qt.WindowCloseButtonHint)
 
-        self.findButton.clicked.connect(self.find)
+        # Поиск идёт по мере набора, после паузы в наборе
+        self.searchTimer = QTimer(self)
+        self.searchTimer.setSingleShot(True)
+        self.searchTimer.setInterval(self.SEARCH_DELAY)
+        self.searchTimer.timeout.connect(self.find)
 
-    def appendExtraSelection(self, tc):
-            
-            ex = QTextEdit.ExtraSelection()            
-            ex.cursor = tc
-            ex.format.setBackground(QBrush(Qt.yellow))
-            self.extraSelections.append(ex)
+        self.findButton.clicked.connect(self.find)
+        self.findAllButton.clicked.connect(self.findAll)
+        self.resultsList.currentItemChanged.connect(self.onResultSelected)
+        self.finding_text.textChanged.connect(self.searchTimer.start)
+        self.comboBox.currentIndexChanged.connect(self.searchTimer.start)
+        self.parent.matchHighlighter.matchCountChanged.connect(self.onMatchCountChanged)
+        self.parent.matchHighlighter.searchFinished.connect(self.onSearchFinished)
+
+    def readMode(self):
+        mode = self.comboBox.currentText()
+        self.isFullWord = mode == "Select full word"
+        self.isPrefix = mode == "Select word start"
 
     def find(self):
-        self.comboBox.currentTextChanged.connect(self.onComboboxChanged)
-
-        if self.changed: 
-            self.extraSelections.clear()
-
+        self.searchTimer.stop()
         pattern = self.finding_text.text()
+        self.readMode()
+        if not pattern:
+            self.parent.matchHighlighter.clear()
+            self.statusLabel.clear()
+            return
 
-        cursor = self.parent.textEdit.textCursor()
-        cursor.setPosition(0)
-        doc = self.parent.textEdit.document()
-
-        regex = QRegExp(pattern)
-
-        self.isFullWord = True if self.comboBox.currentText() == "Select full word" else False
-
-        pos = 0
-        index = regex.indexIn(self.parent.textEdit.toPlainText(), pos)
-        while (index != -1):
-
-            cursor.setPosition(index)
-
-            if self.isFullWord:
-                cursor.movePosition(QTextCursor.EndOfWord, 1)
-                if (cursor.selectionEnd() - cursor.selectionStart() == len(pattern)):
-                    self.appendExtraSelection(cursor)
-
-
-            if not self.isFullWord:
-                cursor = doc.find(pattern, index)
-                if not cursor.isNull(): 
-                    self.appendExtraSelection(cursor)
-
-            pos = index + regex.matchedLength()
-            index = regex.indexIn(self.parent.textEdit.toPlainText(), pos)
+        # Совпадения ищутся в фоне по снимку текста и подсвечиваются по мере нахождения;
+        # новый запрос прерывает предыдущий
+        self.statusLabel.setText("Searching...")
+        self.parent.matchHighlighter.search(searchPattern(pattern, self.isFullWord, self.isPrefix))
 
-        self.parent.textEdit.setExtraSelections(self.extraSelections)
+    def findAll(self):
+        self.searchTimer.stop()
+        self.resultsList.clear()
+        pattern = self.finding_text.text()
+        self.readMode()
+        if not pattern:
+            self.resultsList.hide()
+            self.statusLabel.clear()
+            return
 
-    def closeEvent(self, event):
-        self.extraSelections.clear()
-        self.parent.textEdit.setExtraSelections(self.extraSelections)
-        self.close()
+        pageContents = self.parent.page_contents
+        if pageContents.pending:
+            # Оставшиеся страницы открытого файла извлекаются в фоне, затем поиск повторяется
+            self.statusLabel.setText("Extracting pages...")
+            self.parent.materializePages(self.findAll)
+            return
 
-    def onComboboxChanged(self, value):
-        self.changed = True
+        started = time.perf_counter()
+        if (self.isFullWord or self.isPrefix) and WordIndex.WORD.fullmatch(pattern):
+            # Одно слово целиком или начало слова берутся из индекса без просмотра страниц
+            hits = self.parent.wordIndex.find(pattern, self.isPrefix)
+        else:
+            hits = self.scanPages(searchPattern(pattern, self.isFullWord, self.isPrefix))
+
+        total = 0
+        hitPages = set()
+        shownPage = None
+        for page, start, end in hits:
+            total += 1
+            hitPages.add(page)
+            if total > self.MAX_RESULTS:
+                continue
+            if page != shownPage:
+                shownPage = page
+                text = pageContents.plainText(page)
+                astral = astralPositions(text)
+            snippet = text[max(0, start - self.CONTEXT_CHARS):end + self.CONTEXT_CHARS]
+            item = QListWidgetItem(f"Page {page}: {' '.join(snippet.split())}")
+            item.setData(Qt.UserRole, (page, start + bisect_left(astral, start), end + bisect_left(astral, end)))
+            self.resultsList.addItem(item)
+
+        self.resultsList.show()
+        shown = f", showing first {self.MAX_RESULTS}" if total > self.MAX_RESULTS else ""
+        self.statusLabel.setText(f"Matches: {total} on {len(hitPages)} pages{shown} "
+                                 f"({(time.perf_counter() - started) * 1000:.1f} ms)")
+
+    def scanPages(self, regex):
+        # Ищем по тексту каждой страницы; текст страниц кэшируется по версиям, так что при повторном
+        # поиске заново извлекаются только изменённые страницы
+        pageContents = self.parent.page_contents
+        for page in pageContents.keys():
+            for match in regex.finditer(pageContents.plainText(page)):
+                yield (page,) + match.span()
+
+    def onResultSelected(self, item, previous):
+        if item is None:
+            return
+        page, start, end = item.data(Qt.UserRole)
+        self.parent.showPage(page)
+        textEdit = self.parent.textEdit
+        last = textEdit.document().characterCount() - 1  # страница могла измениться после поиска
+        cursor = textEdit.textCursor()
+        cursor.setPosition(min(start, last))
+        cursor.setPosition(min(end, last), QTextCursor.KeepAnchor)
+        textEdit.setTextCursor(cursor)
+        textEdit.ensureCursorVisible()
+        self.parent.matchHighlighter.updateVisible()
+
+    def onMatchCountChanged(self, count):
+        self.statusLabel.setText(f"Matches: {count}...")
+
+    def onSearchFinished(self, count, seconds):
+        self.statusLabel.setText(f"Matches: {count} ({seconds * 1000:.1f} ms)")
+
+    def hideEvent(self, event):
+        # Подсветка видна, пока открыто окно поиска; Esc скрывает окно, не вызывая closeEvent
+        self.searchTimer.stop()
+        self.parent.matchHighlighter.clear()
+        super().hideEvent(event)
 
         
 class ReplaceDialog(QDialog):
@@ -339,6 +655,2795 @@ class HrefDialog(QDialog):
         self.close()
 
 
+class ImageStore:
+    SCHEME = "image"
+
+    def __init__(self):
+        self.blobs = {}  # hash -> байты изображения
+        self.mapped = {}  # hash -> (смещение, длина) в файле проекта
+        self.decoded = {}  # hash -> QImage
+        self.project = None
+
+    @classmethod
+    def url(cls, key):
+        return f"{cls.SCHEME}://{key}"
+
+    def add(self, data):
+        key = hashlib.sha1(data).hexdigest()
+        if key not in self:
+            self.blobs[key] = data
+        return key
+
+    def data(self, key):
+        if key in self.blobs:
+            return self.blobs[key]
+        offset, length = self.mapped[key]
+        return self.project.read(offset, length)
+
+    def image(self, key):
+        if key not in self:
+            return None
+        if key not in self.decoded:
+            self.decoded[key] = QImage.fromData(self.data(key))
+        return self.decoded[key]
+
+    def keys(self):
+        return sorted(set(self.blobs) | set(self.mapped))
+
+    def snapshot(self):
+        # Копия для фоновых задач, не зависящая от открытого файла проекта
+        images = ImageStore()
+        images.blobs = {key: self.data(key) for key in self.keys()}
+        return images
+
+    def attachProject(self, project):
+        self.project = project
+        for key, entry in project.images.items():
+            self.blobs.pop(key, None)
+            self.mapped[key] = entry
+
+    def reset(self, project=None):
+        self.blobs.clear()
+        self.mapped.clear()
+        self.decoded.clear()
+        self.project = None
+        if project is not None:
+            self.attachProject(project)
+
+    def __contains__(self, key):
+        return key in self.blobs or key in self.mapped
+
+
+class PageDocument(QTextDocument):
+    def __init__(self, images, parent=None):
+        super().__init__(parent)
+        self.images = images
+
+    @classmethod
+    def create(cls, images, font, tabStopDistance):
+        document = cls(images)
+        document.setDefaultFont(font)
+        option = document.defaultTextOption()
+        option.setTabStopDistance(tabStopDistance)
+        document.setDefaultTextOption(option)
+        return document
+
+    def loadResource(self, type, url):
+        # Изображения проекта хранятся один раз в ImageStore и подставляются по хэшу
+        if type == QTextDocument.ImageResource and url.scheme() == ImageStore.SCHEME:
+            image = self.images.image(url.host())
+            if image is not None:
+                return image
+        return super().loadResource(type, url)
+
+
+# mkstemp создаёт файлы с правами 0600; сохранённые файлы должны получать обычные права
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def replaceFile(tempPath, path):
+    # Готовый временный файл занимает место целевого: права берём у заменяемого файла,
+    # а для нового файла — как у созданного обычным open() с текущей umask
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o666 & ~UMASK
+    os.chmod(tempPath, mode)
+    os.replace(tempPath, path)
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def printGeometry(printer):
+    # Раскладка идёт в экранных единицах и масштабируется под принтер, как в QTextDocument.print_
+    screen = QApplication.primaryScreen()
+    sourceDpi = screen.logicalDotsPerInchY() if screen is not None else 96
+    scale = printer.logicalDpiY() / sourceDpi
+    margin = 2 / 2.54 * sourceDpi  # поля 2 см
+    body = QRectF(0, 0, printer.width() / scale, printer.height() / scale)
+    return sourceDpi, scale, margin, body
+
+
+def releaseInGuiThread(document):
+    # Об удалении фреймов и таблиц, созданных Qt, PyQt узнаёт по сигналу destroyed в потоке GUI. Из другого
+    # потока сигнал доходит с задержкой, и за это время новая таблица может занять адрес удалённой:
+    # тогда PyQt посчитает удалённой её обёртку. Поэтому документ, фреймы которого обходились
+    # в фоновом потоке, передаётся потоку GUI, и PyQt удаляет его там через deleteLater
+    application = QApplication.instance()
+    if application is not None and QThread.currentThread() != application.thread():
+        document.moveToThread(application.thread())
+
+
+def layoutPage(html, images, margin, body):
+    document = PageDocument(images)
+    document.setHtml(html)
+    # Поле корневого фрейма задаём через документ: обёртки QTextFrame, созданные в потоке экспорта,
+    # PyQt может спутать с уже удалёнными фреймами других документов
+    document.setDocumentMargin(margin)
+    document.setPageSize(body.size())
+    return document
+
+
+def pageNumberFont(font, sourceDpi):
+    # Номер страницы рисуется уже масштабированным художником, поэтому размер задаём в пикселях
+    font = QFont(font)
+    if font.pointSizeF() > 0:
+        font.setPixelSize(round(font.pointSizeF() * sourceDpi / 72))
+    return font
+
+
+def drawPageNumber(painter, number, font, sourceDpi, margin, body):
+    metrics = QFontMetrics(font)
+    painter.setFont(font)
+    painter.drawText(QPointF(body.width() - margin - metrics.horizontalAdvance(number),
+                             body.height() - margin + metrics.ascent() + 5 * sourceDpi / 72), number)
+
+
+def printPages(printer, pages, images, progress=None):
+    # Каждая страница редактора раскладывается и печатается отдельно, начиная с нового листа,
+    # поэтому в памяти одновременно находится только одна страница
+    painter = QPainter()
+    if not painter.begin(printer):
+        raise IOError("Не удалось начать печать")
+    try:
+        sourceDpi, scale, margin, body = printGeometry(printer)
+        printed = 0
+        done = 0
+        for html in pages:
+            document = layoutPage(html, images, margin, body)
+            font = pageNumberFont(document.defaultFont(), sourceDpi)
+            for index in range(document.pageCount()):
+                if printed:
+                    printer.newPage()
+                printed += 1
+
+                painter.save()
+                painter.scale(scale, scale)
+                painter.save()
+                painter.translate(0, -index * body.height())
+                document.drawContents(painter, body.translated(0, index * body.height()))
+                painter.restore()
+                drawPageNumber(painter, str(printed), font, sourceDpi, margin, body)
+                painter.restore()
+
+            done += 1
+            if progress is not None:
+                progress(done)
+    finally:
+        painter.end()
+
+
+def recordPage(html, images, margin, body):
+    # Листы страницы записываются в QPicture, а не в отдельный PDF: записанные страницы печатаются
+    # подряд в один PDF, и шрифты всего документа встраиваются в него один раз
+    document = layoutPage(html, images, margin, body)
+    sheets = []
+    for index in range(document.pageCount()):
+        picture = QPicture()
+        painter = QPainter(picture)
+        painter.translate(0, -index * body.height())
+        document.drawContents(painter, body.translated(0, index * body.height()))
+        painter.end()
+        # QPicture.data() в PyQt обрезается по первому нулевому байту, поэтому данные берём через буфер
+        buffer = QBuffer()
+        buffer.open(QIODevice.WriteOnly)
+        picture.save(buffer)
+        sheets.append(bytes(buffer.data()))
+    return sheets
+
+
+def printRecorded(printer, pages, progress=None):
+    # pages: листы каждой страницы редактора из recordPage; номера листов сквозные
+    painter = QPainter()
+    if not painter.begin(printer):
+        raise IOError("Не удалось начать печать")
+    try:
+        sourceDpi, scale, margin, body = printGeometry(printer)
+        font = pageNumberFont(QTextDocument().defaultFont(), sourceDpi)
+        printed = 0
+        done = 0
+        for sheets in pages:
+            for data in sheets:
+                if printed:
+                    printer.newPage()
+                printed += 1
+
+                # QPicture сам масштабируется под разрешение принтера от своего, остаётся разница
+                # между ним и разрешением экрана, в котором шла раскладка
+                picture = QPicture()
+                picture.setData(data)
+                painter.save()
+                painter.scale(picture.logicalDpiY() / sourceDpi, picture.logicalDpiY() / sourceDpi)
+                painter.drawPicture(0, 0, picture)
+                painter.restore()
+
+                painter.save()
+                painter.scale(scale, scale)
+                drawPageNumber(painter, str(printed), font, sourceDpi, margin, body)
+                painter.restore()
+
+            done += 1
+            if progress is not None:
+                progress(done)
+    finally:
+        painter.end()
+
+
+# Меньше этого числа страниц процессы не запускаем: их старт дороже последовательной печати
+PARALLEL_EXPORT_MIN_PAGES = 40
+renderApplication = None
+
+
+def initRenderProcess():
+    # Процесс-исполнитель рисует страницы без окон
+    global renderApplication
+    os.environ["QT_QPA_PLATFORM"] = "offscreen"
+    renderApplication = QGuiApplication.instance() or QGuiApplication(["render"])
+
+
+def recordPdfChunk(pages, blobs):
+    # Выполняется в процессе-исполнителе: сжатые html страниц -> листы каждой страницы
+    images = ImageStore()
+    images.blobs = blobs
+    printer = QPrinter(QPrinter.HighResolution)
+    printer.setOutputFormat(QPrinter.PdfFormat)
+    _, _, margin, body = printGeometry(printer)
+    return [recordPage(zlib.decompress(data).decode("utf-8"), images, margin, body) for data, _ in pages]
+
+
+def recordPages(pages, images, workers, progress=None):
+    # pages: [(сжатый html, размер)]; страницы записываются в текущем потоке или частями в пуле процессов
+    if workers <= 1 or len(pages) < 2:
+        printer = QPrinter(QPrinter.HighResolution)
+        printer.setOutputFormat(QPrinter.PdfFormat)
+        _, _, margin, body = printGeometry(printer)
+        recorded = []
+        for data, _ in pages:
+            recorded.append(recordPage(zlib.decompress(data).decode("utf-8"), images, margin, body))
+            if progress is not None:
+                progress(len(recorded))
+        return recorded
+
+    blobs = {key: images.data(key) for key in images.keys()}
+    chunkSize = max(1, -(-len(pages) // (workers * 4)))
+    chunks = [pages[start:start + chunkSize] for start in range(0, len(pages), chunkSize)]
+    results = [None] * len(chunks)
+    done = 0
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=initRenderProcess) as executor:
+        futures = {executor.submit(recordPdfChunk, chunk, blobs): index for index, chunk in enumerate(chunks)}
+        try:
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                done += len(chunks[futures[future]])
+                if progress is not None:
+                    progress(done)
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+    return [sheets for chunk in results for sheets in chunk]
+
+
+def writeRecordedPdf(filePath, pages):
+    # Каждый записанный лист несёт свою копию картинок, поэтому готовый PDF пересохраняется через fitz:
+    # garbage=4 объединяет одинаковые потоки, и картинка встраивается один раз, как при прямой печати
+    fd, tempPath = tempfile.mkstemp(prefix=".", suffix=".pdf", dir=os.path.dirname(os.path.abspath(filePath)))
+    os.close(fd)
+    try:
+        printer = QPrinter(QPrinter.HighResolution)
+        printer.setOutputFormat(QPrinter.PdfFormat)
+        printer.setOutputFileName(tempPath)
+        printRecorded(printer, pages)
+        with fitz.open(tempPath) as document:
+            document.save(filePath, garbage=4, deflate=True)
+    finally:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+
+def exportPdfParallel(filePath, pages, images, workers, progress=None):
+    # Страницы раскладываются частями в процессах, а записанные листы печатаются подряд в один PDF
+    writeRecordedPdf(filePath, recordPages(pages, images, workers, progress))
+
+
+def cacheDirectory(name):
+    base = QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation) or tempfile.gettempdir()
+    return os.path.join(base, "summer_practice", name)
+
+
+def printerSettings():
+    # Всё, от чего зависит вид отрисованной страницы, кроме её html
+    printer = QPrinter(QPrinter.HighResolution)
+    printer.setOutputFormat(QPrinter.PdfFormat)
+    screen = QApplication.primaryScreen()
+    sourceDpi = screen.logicalDotsPerInchY() if screen is not None else 96
+    return f"{printer.pageLayout().fullRectPoints().getRect()}|{printer.resolution()}|{sourceDpi}"
+
+
+class RenderCache:
+    # Записанные листы страниц (QPicture) на диске по хэшу html страницы и параметров печати
+    VERSION = 2  # 2: листы QPicture вместо PDF страницы
+    MAX_BYTES = 512 * 1024 * 1024
+    SUFFIX = ".pic"
+    SHEET = struct.Struct("<I")  # длина листа перед его данными
+
+    def __init__(self, directory=None, maxBytes=MAX_BYTES):
+        self.directory = directory or cacheDirectory("pdf-pictures")
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, html, settings):
+        digest = hashlib.sha256(f"{self.VERSION}|{settings}|".encode("utf-8"))
+        digest.update(html)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key):
+        # Обращение обновляет время файла, по нему вытесняются давно не использованные страницы
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put(self, key, filePath):
+        os.replace(filePath, self.path(key))
+
+    def read(self, key):
+        path = self.get(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as file:
+                return zlib.decompress(file.read())
+        except (OSError, zlib.error):
+            return None
+
+    def write(self, key, data):
+        # Запись через временный файл: читатель не увидит недописанную запись
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tempPath = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(zlib.compress(data))
+            self.put(key, tempPath)
+        except OSError:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+
+    def readSheets(self, key):
+        data = self.read(key)
+        if data is None:
+            return None
+        sheets = []
+        position = 0
+        try:
+            while position < len(data):
+                length, = self.SHEET.unpack_from(data, position)
+                position += self.SHEET.size
+                sheets.append(data[position:position + length])
+                position += length
+        except struct.error:
+            return None
+        return sheets
+
+    def writeSheets(self, key, sheets):
+        self.write(key, b"".join(self.SHEET.pack(len(data)) + data for data in sheets))
+
+    def evict(self):
+        try:
+            entries = [entry for entry in os.scandir(self.directory)
+                       if entry.is_file() and entry.name.endswith(self.SUFFIX)]
+        except FileNotFoundError:
+            return
+        entries = sorted(((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+def hashFile(filePath):
+    digest = hashlib.sha256()
+    with open(filePath, "rb") as file:
+        for chunk in iter(partial(file.read, 1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PdfHtmlCache(RenderCache):
+    # Html страниц, извлечённых из PDF, по хэшу содержимого файла, номеру страницы и режиму импорта
+    VERSION = 2  # 2: строки блока через <br>
+    MAX_BYTES = 128 * 1024 * 1024
+    SUFFIX = ".html.z"
+
+    def __init__(self, directory=None, maxBytes=MAX_BYTES):
+        super().__init__(directory or cacheDirectory("pdf-html"), maxBytes)
+
+    def key(self, fileHash, page, formatted=False):
+        mode = "formatted" if formatted else "text"
+        return hashlib.sha256(f"{self.VERSION}|{fileHash}|{page}|{mode}".encode("utf-8")).hexdigest()
+
+    def readHtml(self, key):
+        data = self.read(key)
+        return None if data is None else data.decode("utf-8")
+
+    def writeHtml(self, key, html):
+        self.write(key, html.encode("utf-8"))
+
+
+class ImportCache(RenderCache):
+    # Импортированные документы целиком в формате проекта: html страниц и картинки.
+    # Хэш содержимого файла запоминается по пути, размеру и времени изменения, поэтому
+    # повторное открытие неизменённого файла не читает его даже для хэширования
+    VERSION = 1
+    MAX_BYTES = 256 * 1024 * 1024
+    SUFFIX = ".sprj"
+    MAX_KNOWN_FILES = 4096
+
+    def __init__(self, directory=None, maxBytes=MAX_BYTES):
+        super().__init__(directory or cacheDirectory("imports"), maxBytes)
+        self.knownFiles = None  # путь -> [размер, время изменения в нс, хэш]
+
+    def indexPath(self):
+        return os.path.join(self.directory, "files.json")
+
+    def fileHash(self, filePath):
+        filePath = os.path.abspath(filePath)
+        stat = os.stat(filePath)
+        if self.knownFiles is None:
+            try:
+                with open(self.indexPath(), encoding="utf-8") as file:
+                    self.knownFiles = json.load(file)
+            except (OSError, ValueError):
+                self.knownFiles = {}
+        known = self.knownFiles.get(filePath)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+
+        fileHash = hashFile(filePath)
+        self.knownFiles.pop(filePath, None)
+        self.knownFiles[filePath] = [stat.st_size, stat.st_mtime_ns, fileHash]
+        while len(self.knownFiles) > self.MAX_KNOWN_FILES:
+            del self.knownFiles[next(iter(self.knownFiles))]
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tempPath = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=self.directory)
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                json.dump(self.knownFiles, file)
+            os.replace(tempPath, self.indexPath())
+        except OSError:
+            pass
+        return fileHash
+
+    def key(self, fileHash, kind):
+        return hashlib.sha256(f"{self.VERSION}|{fileHash}|{kind}".encode("utf-8")).hexdigest()
+
+    def load(self, key):
+        path = self.get(key)
+        if path is None:
+            return None
+        try:
+            return ProjectFile(path)
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def store(self, key, pages, images):
+        # pages: page -> (сжатый html, размер), images: hash -> байты
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            ProjectFile.save(self.path(key), pages, images, {}).close()
+        except (OSError, struct.error):
+            return
+        self.evict()
+
+
+def exportPdfCached(filePath, pages, images, workers, cache, progress=None):
+    # Заново раскладываются только страницы, которых нет в кэше, остальные берутся записанными
+    settings = printerSettings()
+    keys = [cache.key(zlib.decompress(data), settings) for data, _ in pages]
+    recorded = {}
+    missing = {}
+    for key, page in zip(keys, pages):
+        if key in recorded or key in missing:
+            continue
+        sheets = cache.readSheets(key)
+        if sheets is None:
+            missing[key] = page
+        else:
+            recorded[key] = sheets
+
+    cachedPages = sum(1 for key in keys if key not in missing)
+    if progress is not None:
+        progress(cachedPages)
+    renderWorkers = workers if len(missing) >= PARALLEL_EXPORT_MIN_PAGES else 1
+    for key, sheets in zip(missing, recordPages(list(missing.values()), images, renderWorkers,
+                                                None if progress is None else
+                                                lambda done: progress(cachedPages + done))):
+        cache.writeSheets(key, sheets)
+        recorded[key] = sheets
+
+    writeRecordedPdf(filePath, (recorded[key] for key in keys))
+    cache.evict()
+
+
+def benchmarkPdfExport(pageCount=300, maxWorkers=None):
+    maxWorkers = maxWorkers or os.cpu_count() or 1
+    html = "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 12 + "</p>"
+    pages = [(zlib.compress((f"<h2>Page {page}</h2>" + html * 6).encode("utf-8")), 0)
+             for page in range(1, pageCount + 1)]
+    images = ImageStore()
+
+    workerCounts = sorted({1, maxWorkers} | {count for count in (2, 4, 8, 16, 32) if count < maxWorkers})
+    baseline = None
+    print(f"PDF export of {pageCount} pages")
+    with tempfile.TemporaryDirectory(prefix="pdf-benchmark-") as directory:
+        for workers in workerCounts:
+            filePath = os.path.join(directory, f"{workers}.pdf")
+            started = time.perf_counter()
+            if workers == 1:
+                printer = QPrinter(QPrinter.HighResolution)
+                printer.setOutputFormat(QPrinter.PdfFormat)
+                printer.setOutputFileName(filePath)
+                printPages(printer, (zlib.decompress(data).decode("utf-8") for data, _ in pages), images)
+            else:
+                exportPdfParallel(filePath, pages, images, workers)
+            elapsed = time.perf_counter() - started
+            baseline = baseline or elapsed
+            print(f"workers={workers:3d}  {elapsed:8.2f} s  {pageCount / elapsed:8.1f} pages/s  "
+                  f"speedup x{baseline / elapsed:.2f}")
+
+
+TEXT_SAMPLE_SIZE = 64 * 1024
+TEXT_BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+
+def detectEncoding(sample):
+    for bom, encoding in TEXT_BOMS:
+        if sample.startswith(bom):
+            return encoding
+    # Конец образца может обрывать многобайтный символ, поэтому декодируем не до конца
+    for encoding in dict.fromkeys(["utf-8", locale.getpreferredencoding(False).lower(), "cp1251"]):
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return "latin-1"
+
+
+def detectTextEncoding(filePath):
+    with open(filePath, 'rb') as file:
+        return detectEncoding(file.read(TEXT_SAMPLE_SIZE))
+
+
+def readTextFile(filePath, encoding=None):
+    with open(filePath, 'r', encoding=encoding or detectTextEncoding(filePath), errors='replace') as file:
+        return file.read()
+
+
+ZIP_SIGNATURE = b"PK\x03\x04"
+
+
+def isProjectSample(sample):
+    return sample.startswith(ProjectFile.MAGIC)
+
+
+def isPdfSample(sample):
+    # Заголовок должен стоять в начале файла, перед ним допускаются только BOM и пробельные символы:
+    # иначе текст, в начале которого упоминается %PDF-1.7, открывался бы как PDF
+    if sample.startswith(codecs.BOM_UTF8):
+        sample = sample[len(codecs.BOM_UTF8):]
+    return sample.lstrip(b" \t\r\n\f").startswith(b"%PDF-")
+
+
+def isDocxSample(sample):
+    # docx — zip-архив OOXML, основная часть документа лежит в каталоге word/,
+    # записи которого идут в начале архива
+    return sample.startswith(ZIP_SIGNATURE) and b"word/" in sample
+
+
+def isTextSample(sample):
+    # Нулевые байты в тексте встречаются только в UTF-16/32, а такие файлы узнаём по BOM
+    return b"\0" not in sample or any(sample.startswith(bom) for bom, _ in TEXT_BOMS)
+
+
+# Форматы проверяются по порядку: текстом считается всё, что не подошло раньше
+FILE_FORMATS = [
+    ("project", isProjectSample),
+    ("pdf", isPdfSample),
+    ("docx", isDocxSample),
+    ("text", isTextSample),
+]
+
+
+def detectFileFormat(filePath):
+    # Формат определяется по содержимому, а не по расширению, за одно чтение начала файла;
+    # для текста по тому же образцу сразу определяется кодировка. Возвращает (формат или None, кодировка)
+    with open(filePath, 'rb') as file:
+        sample = file.read(TEXT_SAMPLE_SIZE)
+    for fileFormat, matches in FILE_FORMATS:
+        if matches(sample):
+            return fileFormat, detectEncoding(sample) if fileFormat == "text" else None
+    return None, None
+
+
+LARGE_TEXT_FILE_SIZE = 256 * 1024 * 1024  # файлы больше открываются в окне просмотра
+
+
+class LineIndex(QThread):
+    # Файл отображается в память, а индекс хранит только число переводов строк перед каждым блоком:
+    # 8 байт на блок вместо 8 байт на строку, начало строки дочитывается внутри блока
+    BLOCK_SIZE = 64 * 1024
+    MAX_LINE_BYTES = 16 * 1024  # более длинные строки показываются обрезанными
+    progress = pyqtSignal(int)  # проценты
+
+    def __init__(self, filePath, encoding, parent=None):
+        super().__init__(parent)
+        self.filePath = filePath
+        self.file = open(filePath, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.file.close()
+            raise
+        self.size = len(self.map)
+        # BOM пропускаем сами, чтобы строки и шаблоны поиска кодировались без него
+        self.textStart = len(codecs.BOM_UTF8) if self.map[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8 else 0
+        self.encoding = "utf-8" if codecs.lookup(encoding).name == "utf-8-sig" else encoding
+        self.blockLines = array('Q', [0])
+        self.indexedBytes = 0
+
+    @staticmethod
+    def supports(encoding):
+        # Переводы строк ищутся по байтам, это верно только для кодировок, совместимых с ASCII
+        return not codecs.lookup(encoding).name.startswith(("utf-16", "utf-32"))
+
+    def run(self):
+        newlines = 0
+        reported = -1
+        for offset in range(0, self.size, self.BLOCK_SIZE):
+            if self.isInterruptionRequested():
+                return
+            newlines += self.map[offset:offset + self.BLOCK_SIZE].count(b"\n")
+            self.blockLines.append(newlines)
+            self.indexedBytes = min(self.size, offset + self.BLOCK_SIZE)
+            percent = self.indexedBytes * 100 // self.size
+            if percent != reported:
+                reported = percent
+                self.progress.emit(percent)
+
+    def lineCount(self):
+        # Пока индекс строится, известны только строки из уже просмотренной части файла
+        return self.blockLines[-1] + 1
+
+    def lineOffset(self, line):
+        if line == 0:
+            return self.textStart
+        # Последний блок, перед которым меньше line переводов строк, содержит нужный перевод строки
+        block = bisect_left(self.blockLines, line) - 1
+        offset = block * self.BLOCK_SIZE
+        for _ in range(line - self.blockLines[block]):
+            offset = self.map.find(b"\n", offset) + 1
+        return offset
+
+    def locate(self, offset):
+        # Номер строки и позиция в ней для смещения из уже проиндексированной части
+        block = offset // self.BLOCK_SIZE
+        line = self.blockLines[block] + self.map[block * self.BLOCK_SIZE:offset].count(b"\n")
+        lineStart = self.lineOffset(line)
+        return line, len(self.map[lineStart:offset].decode(self.encoding, errors='replace'))
+
+    def lines(self, first, count):
+        result = []
+        last = min(first + count, self.lineCount())
+        if first >= last:
+            return result
+        offset = self.lineOffset(first)
+        for _ in range(first, last):
+            end = self.map.find(b"\n", offset)
+            if end == -1:
+                end = self.size
+            text = self.map[offset:min(end, offset + self.MAX_LINE_BYTES)].decode(self.encoding, errors='replace')
+            if end - offset > self.MAX_LINE_BYTES:
+                text += " ..."
+            result.append(text.rstrip("\r"))
+            offset = end + 1
+        return result
+
+    def find(self, text, offset):
+        # Ищем байты шаблона прямо в отображении файла; (начало, конец) совпадения или None
+        pattern = text.encode(self.encoding, errors='replace')
+        position = self.map.find(pattern, offset, self.indexedBytes)
+        if position == -1:
+            return None
+        return position, position + len(pattern)
+
+    def close(self):
+        self.requestInterruption()
+        self.wait()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+class TextViewer(QDialog):
+    # Просмотр без редактирования: в виджет попадают только видимые строки файла
+    def __init__(self, filePath, encoding, parent=None):
+        super().__init__(parent)
+        self.index = LineIndex(filePath, encoding, self)
+        self.lastSearch = None
+        self.matchEnd = None
+        self.shownLines = 0
+
+        self.setWindowTitle(os.path.basename(filePath))
+        self.setAttribute(Qt.WA_DeleteOnClose)
+
+        layout = QGridLayout()
+        layout.addWidget(QLabel("Line:"), 0, 0)
+        self.lineBox = QSpinBox()
+        self.lineBox.setRange(1, 1)
+        layout.addWidget(self.lineBox, 0, 1)
+        self.goButton = QPushButton("Go")
+        layout.addWidget(self.goButton, 0, 2)
+        layout.addWidget(QLabel("Find:"), 0, 3)
+        self.findText = QLineEdit()
+        layout.addWidget(self.findText, 0, 4)
+        self.findButton = QPushButton("Find next")
+        layout.addWidget(self.findButton, 0, 5)
+
+        self.view = QPlainTextEdit()
+        self.view.setReadOnly(True)
+        self.view.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self.view.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.view.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.view.installEventFilter(self)
+        self.view.viewport().installEventFilter(self)
+        layout.addWidget(self.view, 1, 0, 1, 6)
+        self.scrollBar = QScrollBar(Qt.Vertical)
+        layout.addWidget(self.scrollBar, 1, 6)
+
+        self.statusLabel = QLabel()
+        layout.addWidget(self.statusLabel, 2, 0, 1, 4)
+        self.indexProgress = QProgressBar()
+        self.indexProgress.setRange(0, 100)
+        layout.addWidget(self.indexProgress, 2, 4, 1, 3)
+        self.setLayout(layout)
+        self.resize(900, 600)
+
+        self.scrollBar.valueChanged.connect(self.showLines)
+        self.goButton.clicked.connect(self.goToLine)
+        self.findButton.clicked.connect(self.findNext)
+        self.findText.returnPressed.connect(self.findNext)
+        self.index.progress.connect(self.onIndexProgress)
+        self.index.finished.connect(self.onIndexFinished)
+        self.finished.connect(self.index.close)
+        self.index.start()
+
+    def visibleLines(self):
+        return max(1, self.view.viewport().height() // self.view.fontMetrics().lineSpacing())
+
+    def updateRange(self):
+        lines = self.index.lineCount()
+        self.scrollBar.setPageStep(self.visibleLines())
+        self.scrollBar.setMaximum(max(0, lines - self.visibleLines()))
+        self.lineBox.setMaximum(lines)
+
+    def showLines(self):
+        if self.index.map is None:
+            return
+        first = self.scrollBar.value()
+        lines = self.index.lines(first, self.visibleLines())
+        self.shownLines = len(lines)
+        self.view.setPlainText("\n".join(lines))
+        total = self.index.lineCount()
+        suffix = "" if self.index.isFinished() else "+"
+        self.statusLabel.setText(f"Строки {first + 1}-{first + len(lines)} из {total}{suffix}")
+
+    def onIndexProgress(self, percent):
+        if self.index.map is None:
+            return
+        self.indexProgress.setValue(percent)
+        self.updateRange()
+        # Пока начало файла не проиндексировано целиком, окно может быть заполнено не полностью
+        if self.shownLines < self.visibleLines():
+            self.showLines()
+
+    def onIndexFinished(self):
+        if self.index.map is None:
+            return
+        self.indexProgress.hide()
+        self.updateRange()
+        self.showLines()
+
+    def scrollBy(self, lines):
+        self.scrollBar.setValue(self.scrollBar.value() + lines)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Wheel:
+            self.scrollBy(-event.angleDelta().y() // 120 * 3)
+            return True
+        if event.type() == QEvent.KeyPress:
+            key = event.key()
+            if key == Qt.Key_PageDown:
+                self.scrollBy(self.visibleLines())
+            elif key == Qt.Key_PageUp:
+                self.scrollBy(-self.visibleLines())
+            elif key == Qt.Key_Down:
+                self.scrollBy(1)
+            elif key == Qt.Key_Up:
+                self.scrollBy(-1)
+            elif key == Qt.Key_Home and event.modifiers() & Qt.ControlModifier:
+                self.scrollBar.setValue(0)
+            elif key == Qt.Key_End and event.modifiers() & Qt.ControlModifier:
+                self.scrollBar.setValue(self.scrollBar.maximum())
+            else:
+                return False
+            return True
+        return super().eventFilter(obj, event)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.updateRange()
+        self.showLines()
+
+    def goToLine(self):
+        self.scrollBar.setValue(self.lineBox.value() - 1)
+
+    def findNext(self):
+        text = self.findText.text()
+        if not text:
+            return
+        # Тот же шаблон ищем дальше от прошлого совпадения, новый — с первой видимой строки
+        if text == self.lastSearch:
+            start = self.matchEnd
+        else:
+            start = self.index.lineOffset(self.scrollBar.value())
+        match = self.index.find(text, start)
+        if match is None and start > self.index.textStart:
+            match = self.index.find(text, self.index.textStart)
+        if match is None:
+            self.lastSearch = None
+            building = "" if self.index.isFinished() else " (индекс ещё строится)"
+            self.statusLabel.setText(f"Не найдено: {text}{building}")
+            return
+
+        self.lastSearch = text
+        self.matchEnd = match[1]
+        line, column = self.index.locate(match[0])
+        self.scrollBar.setValue(line)
+        self.showLines()
+
+        block = self.view.document().findBlockByNumber(line - self.scrollBar.value())
+        end = block.position() + block.length() - 1
+        cursor = QTextCursor(block)
+        cursor.setPosition(min(block.position() + column, end))
+        cursor.setPosition(min(block.position() + column + len(text), end), QTextCursor.KeepAnchor)
+        self.view.setTextCursor(cursor)
+
+
+# Меньше этого числа страниц текст извлекается в текущем процессе
+PARALLEL_EXTRACT_MIN_PAGES = 300
+
+
+def pdfPageText(page):
+    return page.get_text("text")
+
+
+def pdfFontFamily(name):
+    # "ABCDEF+Calibri-BoldItalic" и "Arial,Bold" -> имя семейства без префикса подмножества и начертания.
+    # Кавычки и обратную косую черту убираем: имя подставляется в CSS в одинарных кавычках
+    family = name.split("+")[-1].split("-")[0].split(",")[0]
+    return family.translate({ord(char): None for char in "'\"\\"})
+
+
+def pdfSpanHtml(span):
+    style = [f"font-family:'{escape(pdfFontFamily(span['font']))}'",
+             f"font-size:{span['size']:.1f}pt",
+             f"color:#{span['color']:06x}"]
+    if span["flags"] & 16:
+        style.append("font-weight:bold")
+    if span["flags"] & 2:
+        style.append("font-style:italic")
+    return f'<span style="{"; ".join(style)}">{escape(span["text"])}</span>'
+
+
+def pdfPageHtml(page):
+    # Каждый текстовый блок страницы — абзац, строки блока — переносы внутри абзаца
+    paragraphs = []
+    for block in page.get_text("dict", flags=fitz.TEXTFLAGS_TEXT)["blocks"]:
+        if block["type"] != 0:
+            continue
+        lines = []
+        for line in block["lines"]:
+            spans = "".join(pdfSpanHtml(span) for span in line["spans"] if span["text"])
+            if spans:
+                lines.append(spans)
+        if lines:
+            paragraphs.append("<p>" + "<br>".join(lines) + "</p>")
+    return "<html><body>" + "\n".join(paragraphs) + "</body></html>"
+
+
+def extractPdfPages(filePath, pages, extract=pdfPageText):
+    # Выполняется в процессе-исполнителе: каждый процесс открывает файл сам
+    with fitz.open(filePath) as doc:
+        return [extract(doc.load_page(page)) for page in pages]
+
+
+def extractPdfText(filePath, pages=None, workers=1, progress=None, extract=pdfPageText):
+    # Текст страниц в порядке pages (по умолчанию всех); диапазоны страниц делятся между процессами.
+    # extract — функция уровня модуля, чтобы её можно было передать в процесс (например, pdfPageHtml)
+    if pages is None:
+        with fitz.open(filePath) as doc:
+            pages = list(range(doc.page_count))
+    if workers <= 1 or len(pages) < PARALLEL_EXTRACT_MIN_PAGES:
+        texts = []
+        with fitz.open(filePath) as doc:
+            for page in pages:
+                texts.append(extract(doc.load_page(page)))
+                if progress is not None:
+                    progress(len(texts))
+        return texts
+
+    chunkSize = max(1, -(-len(pages) // (workers * 4)))
+    chunks = [pages[start:start + chunkSize] for start in range(0, len(pages), chunkSize)]
+    results = [None] * len(chunks)
+    done = 0
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {executor.submit(extractPdfPages, filePath, chunk, extract): index
+                   for index, chunk in enumerate(chunks)}
+        try:
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                done += len(results[futures[future]])
+                if progress is not None:
+                    progress(done)
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+    return [text for chunk in results for text in chunk]
+
+
+def benchmarkPdfExtract(pageCount=300, maxWorkers=None):
+    maxWorkers = maxWorkers or os.cpu_count() or 1
+    text = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 2
+    workerCounts = sorted({1, maxWorkers} | {count for count in (2, 4, 8, 16, 32) if count < maxWorkers})
+    baseline = None
+    print(f"PDF text extraction of {pageCount} pages")
+    with tempfile.TemporaryDirectory(prefix="pdf-benchmark-") as directory:
+        filePath = os.path.join(directory, "source.pdf")
+        with fitz.open() as document:
+            for page in range(1, pageCount + 1):
+                document.new_page().insert_textbox(fitz.Rect(50, 50, 545, 792), f"Page {page}\n" + text * 20,
+                                                   fontsize=10)
+            document.save(filePath)
+        for workers in workerCounts:
+            started = time.perf_counter()
+            extractPdfText(filePath, workers=workers)
+            elapsed = time.perf_counter() - started
+            baseline = baseline or elapsed
+            print(f"workers={workers:3d}  {elapsed:8.2f} s  {pageCount / elapsed:8.1f} pages/s  "
+                  f"speedup x{baseline / elapsed:.2f}")
+
+
+class PdfPageSource:
+    # Открытый PDF, страницы которого извлекаются по одной при первом обращении.
+    # formatted — импорт с шрифтами и начертаниями; с кэшем готовый html страниц хранится на диске
+    def __init__(self, filePath, cache=None, formatted=False, fileHash=None):
+        self.filePath = filePath
+        self.cache = cache
+        self.formatted = formatted
+        self.document = fitz.open(filePath)
+        self.pageCount = self.document.page_count
+        self.fileHash = fileHash or (hashFile(filePath) if cache is not None else None)
+
+    def convert(self, result):
+        return result if self.formatted else textToPageHtml(result)
+
+    def pageHtml(self, index):
+        extract = pdfPageHtml if self.formatted else pdfPageText
+        if self.cache is None:
+            return self.convert(extract(self.document.load_page(index)))
+        key = self.cache.key(self.fileHash, index, self.formatted)
+        html = self.cache.readHtml(key)
+        if html is None:
+            html = self.convert(extract(self.document.load_page(index)))
+            self.cache.writeHtml(key, html)
+        return html
+
+    def pageHtmls(self, indexes, workers=1, progress=None):
+        # Много страниц сразу: страницы извлекаются параллельно, html текста собирается здесь.
+        # progress получает число готовых страниц, включая взятые из кэша
+        missing = []
+        cached = 0
+        for index in indexes:
+            html = None
+            if self.cache is not None:
+                html = self.cache.readHtml(self.cache.key(self.fileHash, index, self.formatted))
+            if html is None:
+                missing.append(index)
+            else:
+                cached += 1
+                if progress is not None:
+                    progress(cached)
+                yield index, html
+        extract = pdfPageHtml if self.formatted else pdfPageText
+        extracted = extractPdfText(self.filePath, missing, workers,
+                                   None if progress is None else lambda done: progress(cached + done), extract)
+        for index, result in zip(missing, extracted):
+            html = self.convert(result)
+            if self.cache is not None:
+                self.cache.writeHtml(self.cache.key(self.fileHash, index, self.formatted), html)
+            yield index, html
+
+    def close(self):
+        self.document.close()
+        if self.cache is not None:
+            self.cache.evict()
+
+
+class CachedPageSource:
+    # Страницы и картинки ранее импортированного файла из кэша импорта
+    def __init__(self, project, images):
+        self.project = project
+        self.pageCount = len(project.pages)
+        for key in project.images:
+            images.add(project.read(*project.images[key]))
+
+    def pageHtml(self, index):
+        offset, length, _ = self.project.pages[index + 1]
+        return zlib.decompress(self.project.read(offset, length)).decode("utf-8")
+
+    def pageHtmls(self, indexes, workers=1, progress=None):
+        for done, index in enumerate(indexes, 1):
+            yield index, self.pageHtml(index)
+            if progress is not None:
+                progress(done)
+
+    def close(self):
+        self.project.close()
+
+
+class ImportCancelled(Exception):
+    pass
+
+
+class ImportThread(QThread):
+    # Файл разбирается в фоновом потоке: готовые страницы передаются по одной сигналом pageReady,
+    # страницы, извлекаемые по требованию, — источником в сигнале sourceReady
+    progress = pyqtSignal(int)  # проценты
+    pageReady = pyqtSignal(int, object)  # номер от 1 и QTextDocument либо (сжатый html, размер)
+    sourceReady = pyqtSignal(object)
+    REPLACES_PAGES = True  # иначе первая страница файла подставляется в текущую страницу
+
+    def __init__(self, filePath, parent=None):
+        super().__init__(parent)
+        self.filePath = filePath
+        self.images = ImageStore()  # найденные картинки; GUI переносит их в ImageStore проекта
+        self.guiThread = QThread.currentThread()
+        self.error = None
+        self.cancelled = False
+
+    def run(self):
+        try:
+            self.load()
+        except ImportCancelled:
+            self.cancelled = True
+        except Exception as e:
+            self.error = e
+
+    def load(self):
+        raise NotImplementedError
+
+    def reportProgress(self, done, total):
+        if self.isInterruptionRequested():
+            raise ImportCancelled()
+        if total:
+            self.progress.emit(min(100, done * 100 // total))
+
+    def sendDocument(self, page, document):
+        # Документ создан в этом потоке и должен принадлежать потоку GUI
+        document.moveToThread(self.guiThread)
+        self.pageReady.emit(page, document)
+
+
+class TextImportThread(ImportThread):
+    CHUNK_SIZE = 1024 * 1024  # символов за одну вставку
+    REPLACES_PAGES = False
+
+    def __init__(self, filePath, createDocument, encoding=None, parent=None):
+        super().__init__(filePath, parent)
+        self.createDocument = createDocument
+        self.encoding = encoding
+
+    def load(self):
+        # Текст собирается в новом документе без раскладки: в документ, показанный в редакторе,
+        # он вставлялся бы в разы медленнее. История правок для загружаемого текста не нужна
+        total = os.path.getsize(self.filePath)
+        document = self.createDocument()
+        document.setUndoRedoEnabled(False)
+        cursor = QTextCursor(document)
+        encoding = self.encoding or detectTextEncoding(self.filePath)
+        with open(self.filePath, 'r', encoding=encoding, errors='replace') as file:
+            while True:
+                data = file.read(self.CHUNK_SIZE)
+                if not data:
+                    break
+                cursor.movePosition(QTextCursor.End)
+                cursor.insertText(data)
+                self.reportProgress(file.buffer.tell(), total)
+        document.setUndoRedoEnabled(True)
+        self.sendDocument(1, document)
+
+
+class DocxImportThread(ImportThread):
+    def __init__(self, filePath, createDocument, cache, parent=None):
+        super().__init__(filePath, parent)
+        self.createDocument = createDocument
+        self.cache = cache
+
+    def load(self):
+        # Неизменённый файл, уже открывавшийся раньше, берётся из кэша импорта без разбора
+        cacheKey = self.cache.key(self.cache.fileHash(self.filePath), "docx")
+        cached = self.cache.load(cacheKey)
+        if cached is not None:
+            self.sourceReady.emit(CachedPageSource(cached, self.images))
+            return
+
+        # Страницы docx по явным разрывам становятся страницами редактора; в GUI они уходят
+        # сжатым html, как в холодном хранилище, а разобранные документы остаются в этом потоке
+        reader = DocxReader(self.filePath, self.createDocument, self.images)
+        pages = {}
+        for page, document in enumerate(reader.pages(), 1):
+            raw = document.toHtml().encode("utf-8")
+            pages[page] = (zlib.compress(raw, PageStore.COMPRESSION_LEVEL), len(raw))
+            self.pageReady.emit(page, pages[page])
+            self.reportProgress(reader.done, reader.total)
+        self.cache.store(cacheKey, pages, {key: self.images.data(key) for key in self.images.keys()})
+
+
+class PdfImportThread(ImportThread):
+    def __init__(self, filePath, cache, hashes, formatted, parent=None):
+        super().__init__(filePath, parent)
+        self.cache = cache
+        self.hashes = hashes
+        self.formatted = formatted
+
+    def load(self):
+        # Каждая страница PDF становится страницей редактора; текст извлекается при первом просмотре,
+        # поэтому в фоне остаётся только хэширование файла для кэша
+        fileHash = self.hashes.fileHash(self.filePath)
+        self.reportProgress(1, 2)
+        self.sourceReady.emit(PdfPageSource(self.filePath, self.cache, self.formatted, fileHash))
+
+
+def textToPageHtml(text):
+    # Тот же вид, что у текста, открытого в редакторе
+    document = QTextDocument()
+    document.setDefaultFont(QFont("Calibri", 14))
+    document.setPlainText(text)
+    return document.toHtml()
+
+
+def pageHtmlText(html):
+    document = QTextDocument()
+    document.setHtml(html)
+    return document.toPlainText().replace("\ufffc", "")
+
+
+def readPages(inputPath, fileFormat, images, workers=1, formatted=False):
+    # Страницы файла в том виде, в каком их открывает редактор: DOCX — через DocxReader
+    # с таблицами и картинками, PDF — как при импорте, с "Keep PDF Formatting" или без
+    if fileFormat == 'docx':
+        document = QTextDocument()
+        document.setDefaultFont(QFont("Calibri", 14))
+        createDocument = partial(PageDocument.create, images, document.defaultFont(),
+                                 document.defaultTextOption().tabStopDistance())
+        return [page.toHtml() for page in DocxReader(inputPath, createDocument, images).pages()]
+    source = PdfPageSource(inputPath, formatted=formatted)
+    try:
+        return [html for _, html in sorted(source.pageHtmls(range(source.pageCount), workers))]
+    finally:
+        source.close()
+
+
+PIXELS_TO_POINTS = 72 / 96
+DOCX_ALIGNMENT = {
+    int(Qt.AlignLeft): WD_PARAGRAPH_ALIGNMENT.LEFT,
+    int(Qt.AlignHCenter): WD_PARAGRAPH_ALIGNMENT.CENTER,
+    int(Qt.AlignRight): WD_PARAGRAPH_ALIGNMENT.RIGHT,
+    int(Qt.AlignJustify): WD_PARAGRAPH_ALIGNMENT.JUSTIFY,
+}
+
+
+class DocxWriter:
+    # Абзацы вставляются прямо перед sectPr: add_paragraph каждый раз ищет его перебором тела документа,
+    # и запись становится квадратичной. Свойства одинаково оформленных абзацев и фрагментов
+    # задаются один раз и дальше копируются из кэша. Таблицы страницы становятся w:tbl, ссылки — w:hyperlink
+    def __init__(self, images):
+        self.output = Document()
+        self.body = self.output.element.body
+        self.sectPr = self.body.sectPr
+        self.images = images
+        self.paragraphProperties = {}
+        self.runProperties = {}
+        self.hyperlinks = {}  # адрес ссылки -> id связи: relate_to ищет связь перебором всех связей части
+        section = self.output.sections[0]
+        self.textWidth = Length(section.page_width - section.left_margin - section.right_margin).twips
+
+    def addPage(self, document, pageBreak):
+        self.addFrame(document.rootFrame().begin(), document.defaultFont(), pageBreak)
+
+    def insert(self, element, parent=None):
+        if parent is not None:
+            parent.append(element)
+        elif self.sectPr is not None:
+            self.sectPr.addprevious(element)
+        else:
+            self.body.append(element)
+
+    def addFrame(self, iterator, defaultFont, pageBreak=False, parent=None):
+        # Абзацы и таблицы фрейма по порядку; перед фреймом в Qt всегда есть блок, и разрыв страницы
+        # достаётся абзацу. Возвращает последний добавленный элемент
+        last = None
+        while not iterator.atEnd():
+            frame = iterator.currentFrame()
+            if frame is None:
+                last = self.addParagraph(iterator.currentBlock(), defaultFont, pageBreak, parent)._p
+            elif isinstance(frame, QTextTable):
+                last = self.addTable(frame, defaultFont, parent)
+            else:
+                last = self.addFrame(frame.begin(), defaultFont, pageBreak, parent)
+            pageBreak = False
+            iterator += 1
+        return last
+
+    def addTable(self, table, defaultFont, parent=None):
+        element = OxmlElement("w:tbl")
+        self.insert(element, parent)
+        tableFormat = table.format()
+        properties = OxmlElement("w:tblPr")
+        width = OxmlElement("w:tblW")
+        width.set(qn("w:w"), "0")
+        width.set(qn("w:type"), "auto")
+        properties.append(width)
+        if tableFormat.border() > 0:
+            # Рамка, как у таблиц, которые создаёт DocxReader
+            borders = OxmlElement("w:tblBorders")
+            for side in ("top", "left", "bottom", "right", "insideH", "insideV"):
+                border = OxmlElement("w:" + side)
+                border.set(qn("w:val"), "single")
+                border.set(qn("w:sz"), "4")
+                borders.append(border)
+            properties.append(borders)
+        element.append(properties)
+
+        # Ширины столбцов в процентах переводятся в доли ширины текста страницы
+        columns = table.columns()
+        constraints = tableFormat.columnWidthConstraints()
+        grid = OxmlElement("w:tblGrid")
+        for column in range(columns):
+            share = 100 / columns
+            if len(constraints) == columns and constraints[column].type() == QTextLength.PercentageLength:
+                share = constraints[column].rawValue()
+            gridColumn = OxmlElement("w:gridCol")
+            gridColumn.set(qn("w:w"), str(round(self.textWidth * share / 100)))
+            grid.append(gridColumn)
+        element.append(grid)
+
+        nested = {frame.firstPosition(): frame for frame in table.childFrames()}
+        for row in range(table.rows()):
+            rowElement = OxmlElement("w:tr")
+            element.append(rowElement)
+            for column in range(columns):
+                cell = table.cellAt(row, column)
+                if cell.column() != column:
+                    continue  # столбец занят ячейкой, объединённой по горизонтали
+                cellElement = OxmlElement("w:tc")
+                rowElement.append(cellElement)
+                cellProperties = OxmlElement("w:tcPr")
+                if cell.columnSpan() > 1:
+                    span = OxmlElement("w:gridSpan")
+                    span.set(qn("w:val"), str(cell.columnSpan()))
+                    cellProperties.append(span)
+                if cell.rowSpan() > 1:
+                    # Продолжения объединённой по вертикали ячейки — пустые ячейки с vMerge без значения
+                    merge = OxmlElement("w:vMerge")
+                    if cell.row() == row:
+                        merge.set(qn("w:val"), "restart")
+                    cellProperties.append(merge)
+                if len(cellProperties):
+                    cellElement.append(cellProperties)
+                last = None
+                if cell.row() == row:
+                    last = self.addCell(cell, nested, defaultFont, cellElement)
+                if last is None or last.tag != qn("w:p"):
+                    # Ячейка должна заканчиваться абзацем
+                    cellElement.append(OxmlElement("w:p"))
+        return element
+
+    def addCell(self, cell, nested, defaultFont, parent):
+        # У QTextTableCell в PyQt нет итератора: блоки ячейки перебираются по позициям,
+        # вложенные таблицы находятся среди дочерних фреймов таблицы по первой позиции
+        last = None
+        block = cell.firstCursorPosition().block()
+        end = cell.lastCursorPosition().position()
+        while block.isValid() and block.position() <= end:
+            frame = nested.get(block.position())
+            if frame is None:
+                last = self.addParagraph(block, defaultFont, parent=parent)._p
+                block = block.next()
+                continue
+            if isinstance(frame, QTextTable):
+                last = self.addTable(frame, defaultFont, parent)
+            else:
+                last = self.addFrame(frame.begin(), defaultFont, parent=parent)
+            cursor = frame.lastCursorPosition()
+            cursor.movePosition(QTextCursor.NextBlock)
+            block = cursor.block()
+        return last
+
+    def addParagraph(self, block, defaultFont, pageBreak=False, parent=None):
+        element = OxmlElement("w:p")
+        self.insert(element, parent)
+        paragraph = Paragraph(element, self.output)
+
+        # Те же параметры абзаца, что задаёт applyTextStyle: выравнивание, отступы, межстрочный интервал
+        blockFormat = block.blockFormat()
+        key = (int(blockFormat.alignment() & Qt.AlignHorizontal_Mask), blockFormat.leftMargin(),
+               blockFormat.rightMargin(), blockFormat.lineHeightType(), blockFormat.lineHeight(), pageBreak)
+        if key in self.paragraphProperties:
+            template = self.paragraphProperties[key]
+            if template is not None:
+                element.insert(0, deepcopy(template))
+        else:
+            self.applyParagraphFormat(paragraph, blockFormat, pageBreak)
+            self.paragraphProperties[key] = deepcopy(element.pPr) if element.pPr is not None else None
+
+        # Подряд идущие фрагменты с одним адресом ссылки собираются в один w:hyperlink
+        hyperlink = None
+        href = None
+        fragments = block.begin()
+        while not fragments.atEnd():
+            fragment = fragments.fragment()
+            run = self.addRun(paragraph, fragment, defaultFont) if fragment.isValid() else None
+            if run is not None:
+                charFormat = fragment.charFormat()
+                fragmentHref = charFormat.anchorHref() if charFormat.isAnchor() else ""
+                if not fragmentHref:
+                    hyperlink = None
+                elif hyperlink is None or fragmentHref != href:
+                    hyperlink = self.addHyperlink(run, fragmentHref)
+                else:
+                    hyperlink.append(run._r)
+                href = fragmentHref
+            fragments += 1
+        return paragraph
+
+    def addHyperlink(self, run, href):
+        hyperlink = OxmlElement("w:hyperlink")
+        if href.startswith("#"):
+            hyperlink.set(qn("w:anchor"), href[1:])
+        else:
+            if href not in self.hyperlinks:
+                self.hyperlinks[href] = self.output.part.relate_to(href, RT.HYPERLINK, is_external=True)
+            hyperlink.set(qn("r:id"), self.hyperlinks[href])
+        run._r.addprevious(hyperlink)
+        hyperlink.append(run._r)
+        return hyperlink
+
+    def applyParagraphFormat(self, paragraph, blockFormat, pageBreak):
+        alignment = DOCX_ALIGNMENT.get(int(blockFormat.alignment() & Qt.AlignHorizontal_Mask))
+        if alignment is not None:
+            paragraph.alignment = alignment
+
+        paragraphFormat = paragraph.paragraph_format
+        if pageBreak:
+            paragraphFormat.page_break_before = True
+        if blockFormat.leftMargin():
+            paragraphFormat.left_indent = Pt(blockFormat.leftMargin() * PIXELS_TO_POINTS)
+        if blockFormat.rightMargin():
+            paragraphFormat.right_indent = Pt(blockFormat.rightMargin() * PIXELS_TO_POINTS)
+        if blockFormat.lineHeightType() == QTextBlockFormat.FixedHeight and blockFormat.lineHeight() > 0:
+            paragraphFormat.line_spacing = Pt(blockFormat.lineHeight() * PIXELS_TO_POINTS)
+        elif blockFormat.lineHeightType() == QTextBlockFormat.ProportionalHeight and blockFormat.lineHeight() > 0:
+            paragraphFormat.line_spacing = blockFormat.lineHeight() / 100
+
+    def addRun(self, paragraph, fragment, defaultFont):
+        charFormat = fragment.charFormat()
+        if charFormat.isImageFormat():
+            imageFormat = charFormat.toImageFormat()
+            url = QUrl(imageFormat.name())
+            if url.scheme() == ImageStore.SCHEME and url.host() in self.images:
+                width = Pt(imageFormat.width() * PIXELS_TO_POINTS) if imageFormat.width() > 0 else None
+                run = paragraph.add_run()
+                run.add_picture(BytesIO(self.images.data(url.host())), width=width)
+                return run
+            return None
+
+        run = paragraph.add_run(fragment.text().replace("\u2028", "\n"))
+        font = charFormat.font().resolve(defaultFont)
+        size = font.pointSizeF()
+        if size <= 0 and font.pixelSize() > 0:
+            size = font.pixelSize() * PIXELS_TO_POINTS
+        color = None
+        if charFormat.foreground().style() != Qt.NoBrush:
+            color = charFormat.foreground().color().name()
+
+        key = (font.family(), size, font.bold(), font.italic(), font.underline(), font.strikeOut(), color)
+        if key in self.runProperties:
+            run._r.insert(0, deepcopy(self.runProperties[key]))
+            return run
+
+        run.font.name = font.family()
+        if size > 0:
+            run.font.size = Pt(size)
+        if font.bold():
+            run.font.bold = True
+        if font.italic():
+            run.font.italic = True
+        if font.underline():
+            run.font.underline = True
+        if font.strikeOut():
+            run.font.strike = True
+        if color is not None:
+            run.font.color.rgb = RGBColor.from_string(color[1:])
+        self.runProperties[key] = deepcopy(run._r.rPr)
+        return run
+
+    def save(self, filePath):
+        self.output.save(filePath)
+
+
+DOCX_QT_ALIGNMENT = {alignment: qtAlignment for qtAlignment, alignment in DOCX_ALIGNMENT.items()}
+EMU_PER_PIXEL = 9525
+VML_IMAGEDATA = "{urn:schemas-microsoft-com:vml}imagedata"
+
+
+class DocxReader:
+    # Обратная сторона DocxWriter: фрагменты становятся QTextCharFormat, свойства абзацев — QTextBlockFormat
+    # (те же, что задаёт applyTextStyle). Документ делится на страницы по явным разрывам, текст вставляется
+    # курсором блоками правки по BATCH_PARAGRAPHS абзацев, без сборки одной огромной html-строки.
+    # Таблицы становятся QTextTable, картинки попадают в ImageStore
+    BATCH_PARAGRAPHS = 256
+
+    def __init__(self, filePath, createDocument, images):
+        self.source = Document(filePath)
+        self.createDocument = createDocument
+        self.images = images
+        self.styleChains = {}
+        self.styleFonts = {}
+        self.styleParagraphs = {}
+        self.charFormats = {}
+        self.blockFormats = {}
+        self.document = None
+        self.pageCursor = None
+        self.cursor = None  # куда вставляется текст: в страницу или в ячейку таблицы
+        self.emptyPage = True
+        self.freeBlock = True  # текущий блок пуст и ещё не занят абзацем
+        self.tableDepth = 0
+        self.paragraphs = 0
+        self.done = 0  # разобрано элементов тела документа из total
+        self.total = 0
+
+        # Шрифт по умолчанию из docDefaults: у стиля Normal его обычно нет
+        self.defaultFamily = None
+        self.defaultSize = None
+        for rPr in self.source.styles.element.xpath("w:docDefaults/w:rPrDefault/w:rPr"):
+            fonts = rPr.find(qn("w:rFonts"))
+            if fonts is not None:
+                self.defaultFamily = fonts.get(qn("w:ascii"))
+            size = rPr.find(qn("w:sz"))
+            if size is not None and size.get(qn("w:val"), "").isdigit():
+                self.defaultSize = int(size.get(qn("w:val"))) / 2
+
+    def pages(self):
+        # Готовые страницы отдаются по одной, чтобы хранилище успевало вытеснять их по мере чтения
+        self.startPage()
+        children = list(self.source.element.body.iterchildren())
+        self.total = len(children)
+        for self.done, child in enumerate(children, 1):
+            yield from self.addElement(child)
+        yield self.finishPage()
+
+    def addContent(self, element):
+        # Абзацы и таблицы тела документа или ячейки по порядку
+        for child in element.iterchildren():
+            yield from self.addElement(child)
+
+    def addElement(self, element):
+        if element.tag == qn("w:p"):
+            yield from self.addParagraph(Paragraph(element, self.source))
+        elif element.tag == qn("w:tbl"):
+            self.addTable(element)
+
+    def startPage(self):
+        self.document = self.createDocument()
+        self.document.setUndoRedoEnabled(False)
+        self.pageCursor = QTextCursor(self.document)
+        self.pageCursor.beginEditBlock()
+        self.cursor = self.pageCursor
+        self.emptyPage = True
+        self.freeBlock = True
+        self.paragraphs = 0
+
+    def finishPage(self):
+        self.pageCursor.endEditBlock()
+        self.document.setUndoRedoEnabled(True)
+        return self.document
+
+    def newPage(self):
+        document = self.finishPage()
+        self.startPage()
+        return document
+
+    def startBlock(self, blockFormat):
+        if self.freeBlock:
+            self.cursor.setBlockFormat(blockFormat)
+            self.freeBlock = False
+        else:
+            self.cursor.insertBlock(blockFormat)
+        self.emptyPage = False
+        self.paragraphs += 1
+        if self.paragraphs % self.BATCH_PARAGRAPHS == 0:
+            self.pageCursor.endEditBlock()
+            self.pageCursor.beginEditBlock()
+
+    def addParagraph(self, paragraph):
+        # Разрывы страниц внутри таблиц не поддерживаются и пропускаются
+        blockFormat, pageBreakBefore = self.blockFormat(paragraph)
+        if pageBreakBefore and not self.emptyPage and not self.tableDepth:
+            yield self.newPage()
+
+        # Блок открывается с первым текстом: абзац из одного разрыва страницы не оставляет пустых строк
+        opened = False
+        brokeAfter = False
+        for run, href in self.runs(paragraph):
+            charFormat = self.charFormat(run, paragraph, href)
+            for item in self.runContent(run):
+                if item is None:
+                    if self.tableDepth:
+                        continue
+                    yield self.newPage()
+                    opened = False
+                    brokeAfter = True
+                    continue
+                if not opened:
+                    self.startBlock(blockFormat)
+                    opened = True
+                if isinstance(item, QTextImageFormat):
+                    self.cursor.insertImage(item)
+                else:
+                    self.cursor.insertText(item, charFormat)
+                brokeAfter = False
+        if not opened and not brokeAfter:
+            self.startBlock(blockFormat)
+
+    def addTable(self, table):
+        rows = table.findall(qn("w:tr"))
+        if not rows:
+            return
+        grid = table.find(qn("w:tblGrid"))
+        widths = []
+        if grid is not None:
+            widths = [int(column.get(qn("w:w"), "0")) for column in grid.findall(qn("w:gridCol"))]
+        columns = max([len(widths)] + [sum(self.cellSpan(cell) for cell in row.findall(qn("w:tc"))) for row in rows])
+        if not columns:
+            return
+
+        tableFormat = QTextTableFormat()
+        tableFormat.setBorder(1)
+        tableFormat.setCellSpacing(0)
+        tableFormat.setCellPadding(4)
+        if len(widths) == columns and sum(widths):
+            # Ширины столбцов из сетки таблицы в долях от ширины страницы
+            tableFormat.setWidth(QTextLength(QTextLength.PercentageLength, 100))
+            tableFormat.setColumnWidthConstraints(
+                [QTextLength(QTextLength.PercentageLength, width * 100 / sum(widths)) for width in widths])
+        textTable = self.cursor.insertTable(len(rows), columns, tableFormat)
+        self.emptyPage = False
+
+        # Объединённые по вертикали ячейки: продолжения пропускаем, в конце объединяем с первой
+        merges = []
+        verticalStarts = {}
+        outerCursor = self.cursor
+        self.tableDepth += 1
+        for rowIndex, row in enumerate(rows):
+            column = 0
+            for cell in row.findall(qn("w:tc")):
+                span = self.cellSpan(cell)
+                if column >= columns:
+                    break
+                span = min(span, columns - column)
+                merge = cell.find(qn("w:tcPr") + "/" + qn("w:vMerge"))
+                if merge is not None and merge.get(qn("w:val")) != "restart" and column in verticalStarts:
+                    verticalStarts[column][2] = rowIndex - verticalStarts[column][0] + 1
+                    column += span
+                    continue
+                entry = [rowIndex, column, 1, span]
+                merges.append(entry)
+                verticalStarts[column] = entry
+                self.cursor = textTable.cellAt(rowIndex, column).firstCursorPosition()
+                self.freeBlock = True
+                for _ in self.addContent(cell):
+                    pass
+                column += span
+        self.tableDepth -= 1
+        for rowIndex, column, rowSpan, columnSpan in merges:
+            if rowSpan > 1 or columnSpan > 1:
+                textTable.mergeCells(rowIndex, column, rowSpan, columnSpan)
+
+        # Дальше текст идёт в блок сразу после таблицы
+        self.cursor = textTable.lastCursorPosition()
+        self.cursor.movePosition(QTextCursor.NextBlock)
+        if outerCursor is self.pageCursor:
+            self.pageCursor.setPosition(self.cursor.position())
+            self.cursor = self.pageCursor
+        self.freeBlock = True
+
+    @staticmethod
+    def cellSpan(cell):
+        span = cell.find(qn("w:tcPr") + "/" + qn("w:gridSpan"))
+        value = span.get(qn("w:val"), "1") if span is not None else "1"
+        return int(value) if value.isdigit() and int(value) > 0 else 1
+
+    def runs(self, paragraph):
+        # Фрагменты абзаца по порядку, включая фрагменты внутри гиперссылок
+        for child in paragraph._p.iterchildren():
+            if child.tag == qn("w:r"):
+                yield Run(child, paragraph), None
+            elif child.tag == qn("w:hyperlink"):
+                href = None
+                relationId = child.get(qn("r:id"))
+                if relationId and relationId in paragraph.part.rels:
+                    href = paragraph.part.rels[relationId].target_ref
+                elif child.get(qn("w:anchor")):
+                    href = "#" + child.get(qn("w:anchor"))
+                for element in child.iterchildren(qn("w:r")):
+                    yield Run(element, paragraph), href
+
+    def runContent(self, run):
+        # Текст и картинки фрагмента в порядке элементов; None — явный разрыв страницы
+        for child in run._r.iterchildren():
+            if child.tag == qn("w:t"):
+                yield child.text or ""
+            elif child.tag == qn("w:tab"):
+                yield "\t"
+            elif child.tag in (qn("w:br"), qn("w:cr")):
+                yield None if child.get(qn("w:type")) == "page" else "\u2028"
+            elif child.tag in (qn("w:drawing"), qn("w:pict")):
+                imageFormat = self.imageFormat(child, run)
+                if imageFormat is not None:
+                    yield imageFormat
+
+    def imageFormat(self, element, run):
+        # Байты картинки кладутся в ImageStore без декодирования: одинаковые картинки по хэшу хранятся
+        # один раз, а декодируются только при показе страницы через PageDocument.loadResource
+        relationIds = [blip.get(qn("r:embed")) for blip in element.iter(qn("a:blip"))]
+        relationIds += [data.get(qn("r:id")) for data in element.iter(VML_IMAGEDATA)]
+        for relationId in relationIds:
+            part = run.part.related_parts.get(relationId) if relationId else None
+            if part is None:
+                continue
+            imageFormat = QTextImageFormat()
+            imageFormat.setName(ImageStore.url(self.images.add(part.blob)))
+            extent = next(element.iter(qn("wp:extent")), None)
+            if extent is not None and extent.get("cx", "").isdigit() and extent.get("cy", "").isdigit():
+                imageFormat.setWidth(int(extent.get("cx")) / EMU_PER_PIXEL)
+                imageFormat.setHeight(int(extent.get("cy")) / EMU_PER_PIXEL)
+            return imageFormat
+        return None
+
+    def styleChain(self, kind, styleId, getStyle):
+        # Стиль и все его базовые стили; значения, не заданные напрямую, берутся по этой цепочке
+        key = (kind, styleId)
+        if key not in self.styleChains:
+            chain = []
+            style = getStyle()
+            while style is not None:
+                chain.append(style)
+                style = style.base_style
+            self.styleChains[key] = chain
+        return self.styleChains[key]
+
+    @staticmethod
+    def merge(values, fallback):
+        # Значения, не заданные (None) в values, берутся из fallback
+        return tuple(fallback[index] if value is None else value for index, value in enumerate(values))
+
+    @staticmethod
+    def fontValues(font):
+        size = font.size
+        color = font.color.rgb if font.color.type is not None else None
+        return (font.name, size.pt if size is not None else None, font.bold, font.italic, font.underline,
+                font.strike, str(color) if color is not None else None)
+
+    @staticmethod
+    def paragraphValues(paragraphFormat):
+        return (paragraphFormat.alignment, paragraphFormat.left_indent, paragraphFormat.right_indent,
+                paragraphFormat.line_spacing, paragraphFormat.page_break_before)
+
+    def charFormat(self, run, paragraph, href):
+        # Значения стилей считаются один раз на сочетание стилей, у фрагмента проверяется только его rPr
+        key = (run._r.style, paragraph._p.style)
+        if key not in self.styleFonts:
+            chain = (self.styleChain("run", run._r.style, lambda: run.style)
+                     + self.styleChain("paragraph", paragraph._p.style, lambda: paragraph.style))
+            values = (self.defaultFamily, self.defaultSize, None, None, None, None, None)
+            for style in reversed(chain):
+                values = self.merge(self.fontValues(style.font), values)
+            self.styleFonts[key] = values
+        values = self.styleFonts[key]
+        if run._r.rPr is not None:
+            values = self.merge(self.fontValues(run.font), values)
+
+        key = values + (href,)
+        if key in self.charFormats:
+            return self.charFormats[key]
+
+        family, size, bold, italic, underline, strike, color, href = key
+        charFormat = QTextCharFormat()
+        if family:
+            charFormat.setFontFamily(family)
+        if size:
+            charFormat.setFontPointSize(size)
+        if bold:
+            charFormat.setFontWeight(QFont.Bold)
+        if italic:
+            charFormat.setFontItalic(True)
+        if underline:
+            charFormat.setFontUnderline(True)
+        if strike:
+            charFormat.setFontStrikeOut(True)
+        if color is not None:
+            charFormat.setForeground(QColor("#" + color))
+        if href:
+            # Как у ссылок, вставленных через HrefDialog
+            if color is None:
+                charFormat.setForeground(QColor("blue"))
+            charFormat.setFontUnderline(True)
+            charFormat.setAnchor(True)
+            charFormat.setAnchorHref(href)
+            charFormat.setToolTip(href)
+        self.charFormats[key] = charFormat
+        return charFormat
+
+    def blockFormat(self, paragraph):
+        key = paragraph._p.style
+        if key not in self.styleParagraphs:
+            values = (None,) * 5
+            for style in reversed(self.styleChain("paragraph", paragraph._p.style, lambda: paragraph.style)):
+                values = self.merge(self.paragraphValues(style.paragraph_format), values)
+            self.styleParagraphs[key] = values
+        values = self.styleParagraphs[key]
+        if paragraph._p.pPr is not None:
+            values = self.merge(self.paragraphValues(paragraph.paragraph_format), values)
+
+        alignment, leftIndent, rightIndent, lineSpacing, pageBreakBefore = values
+        pageBreakBefore = bool(pageBreakBefore)
+        key = (alignment, leftIndent, rightIndent, lineSpacing)
+        if key in self.blockFormats:
+            return self.blockFormats[key], pageBreakBefore
+
+        blockFormat = QTextBlockFormat()
+        if alignment in DOCX_QT_ALIGNMENT:
+            blockFormat.setAlignment(Qt.Alignment(DOCX_QT_ALIGNMENT[alignment]))
+        if leftIndent:
+            blockFormat.setLeftMargin(leftIndent.pt / PIXELS_TO_POINTS)
+        if rightIndent:
+            blockFormat.setRightMargin(rightIndent.pt / PIXELS_TO_POINTS)
+        if isinstance(lineSpacing, Length):
+            blockFormat.setLineHeight(lineSpacing.pt / PIXELS_TO_POINTS, QTextBlockFormat.FixedHeight)
+        elif lineSpacing:
+            blockFormat.setLineHeight(lineSpacing * 100, QTextBlockFormat.ProportionalHeight)
+        self.blockFormats[key] = blockFormat
+        return blockFormat, pageBreakBefore
+
+
+def writeDocx(filePath, pages, images, progress=None):
+    # Страницы разбираются по одной: из каждой строится документ, переносится в docx и освобождается
+    writer = DocxWriter(images)
+    done = 0
+    for html in pages:
+        document = PageDocument(images)
+        document.setHtml(html)
+        writer.addPage(document, pageBreak=done > 0)
+        releaseInGuiThread(document)
+
+        done += 1
+        if progress is not None:
+            progress(done)
+    writer.save(filePath)
+
+
+def benchmarkDocxExport(pageCount=200):
+    document = QTextDocument()
+    cursor = QTextCursor(document)
+    charFormat = QTextCharFormat()
+    charFormat.setFont(QFont("Calibri", 14))
+    charFormat.setForeground(QColor("#00aaff"))
+    blockFormat = QTextBlockFormat()
+    blockFormat.setAlignment(Qt.AlignJustify)
+    blockFormat.setLeftMargin(20)
+    blockFormat.setLineHeight(25, QTextBlockFormat.FixedHeight)
+    for paragraph in range(20):
+        cursor.insertBlock(blockFormat, charFormat)
+        cursor.insertText("Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 4, charFormat)
+        boldFormat = QTextCharFormat(charFormat)
+        boldFormat.setFontWeight(QFont.Bold)
+        cursor.insertText("Sed do eiusmod tempor.", boldFormat)
+    html = document.toHtml()
+
+    with tempfile.TemporaryDirectory(prefix="docx-benchmark-") as directory:
+        filePath = os.path.join(directory, "benchmark.docx")
+        started = time.perf_counter()
+        writeDocx(filePath, (html for _ in range(pageCount)), ImageStore())
+        elapsed = time.perf_counter() - started
+        print(f"DOCX export of {pageCount} pages: {elapsed:.2f} s, {pageCount / elapsed:.1f} pages/s, "
+              f"{os.path.getsize(filePath) / 1024:.0f} KiB")
+
+
+class MaterializeThread(QThread):
+    # Страницы открытого файла, которые извлекаются по требованию, перед экспортом, сохранением проекта
+    # и поиском по всем страницам извлекаются здесь все сразу, не задерживая интерфейс
+    progress = pyqtSignal(int, int)
+    pageReady = pyqtSignal(int, object, int, str)  # страница, источник, номер в источнике, html
+
+    def __init__(self, groups, workers=1, parent=None):
+        super().__init__(parent)
+        self.groups = groups  # [(источник, {номер в источнике: страница})]
+        self.workers = workers
+        self.total = sum(len(pages) for _, pages in groups)
+        self.error = None
+        self.cancelled = False
+
+    def run(self):
+        done = 0
+        try:
+            for source, pages in self.groups:
+                progress = lambda count: self.reportProgress(done + count)
+                for index, html in source.pageHtmls(sorted(pages), self.workers, progress):
+                    self.pageReady.emit(pages[index], source, index, html)
+                done += len(pages)
+        except ImportCancelled:
+            self.cancelled = True
+        except Exception as e:
+            self.error = e
+
+    def reportProgress(self, done):
+        if self.isInterruptionRequested():
+            raise ImportCancelled()
+        self.progress.emit(done, self.total)
+
+
+class ExportThread(QThread):
+    progress = pyqtSignal(int, int)
+    SUFFIX = ""
+
+    def __init__(self, filePath, pages, images, parent=None):
+        super().__init__(parent)
+        self.filePath = filePath
+        self.pages = pages  # сжатые html страниц: [(данные, размер)]
+        self.images = images
+        self.error = None
+        self.cancelled = False
+
+    def run(self):
+        # Пишем во временный файл рядом с целевым, чтобы отмена не оставила недописанный файл
+        fd, tempPath = tempfile.mkstemp(prefix=".", suffix=self.SUFFIX,
+                                        dir=os.path.dirname(os.path.abspath(self.filePath)))
+        os.close(fd)
+        try:
+            self.export(tempPath)
+            replaceFile(tempPath, self.filePath)
+        except ExportCancelled:
+            self.cancelled = True
+        except Exception as e:
+            self.error = e
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+
+    def export(self, filePath):
+        raise NotImplementedError
+
+    def pageHtmls(self):
+        for data, _ in self.pages:
+            yield zlib.decompress(data).decode("utf-8")
+
+    def reportProgress(self, done):
+        if self.isInterruptionRequested():
+            raise ExportCancelled()
+        self.progress.emit(done, len(self.pages))
+
+
+class PdfExportThread(ExportThread):
+    SUFFIX = ".pdf"
+
+    def __init__(self, filePath, pages, images, workers=1, cache=None, parent=None):
+        super().__init__(filePath, pages, images, parent)
+        self.workers = workers
+        self.cache = cache
+
+    def export(self, filePath):
+        if self.cache is not None:
+            exportPdfCached(filePath, self.pages, self.images, self.workers, self.cache, self.reportProgress)
+        elif self.workers > 1 and len(self.pages) >= PARALLEL_EXPORT_MIN_PAGES:
+            exportPdfParallel(filePath, self.pages, self.images, self.workers, self.reportProgress)
+        else:
+            printer = QPrinter(QPrinter.HighResolution)
+            printer.setOutputFormat(QPrinter.PdfFormat)
+            printer.setOutputFileName(filePath)
+            printPages(printer, self.pageHtmls(), self.images, self.reportProgress)
+
+
+class DocxExportThread(ExportThread):
+    SUFFIX = ".docx"
+
+    def export(self, filePath):
+        writeDocx(filePath, self.pageHtmls(), self.images, self.reportProgress)
+
+
+class ProjectFile:
+    # Заголовок, блоки страниц, стилей и изображений, в конце таблица смещений
+    MAGIC = b"SPRJ"
+    VERSION = 1
+    EXTENSION = ".sprj"
+    HEADER = struct.Struct("<4sHHQQ")  # сигнатура, версия, резерв, смещение и длина таблицы
+    INDEX = struct.Struct("<IIQI")  # число страниц, число изображений, смещение и длина стилей
+    PAGE_ENTRY = struct.Struct("<IQII")  # страница, смещение, длина, размер html
+    IMAGE_ENTRY = struct.Struct("<40sQI")  # хэш, смещение, длина
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.file = open(self.path, "rb")
+        self.map = None
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, _, indexOffset, indexLength = self.HEADER.unpack_from(self.map, 0)
+            if magic != self.MAGIC or version > self.VERSION:
+                raise ValueError("Файл не является проектом или создан более новой версией")
+
+            pageCount, imageCount, stylesOffset, stylesLength = self.INDEX.unpack_from(self.map, indexOffset)
+            position = indexOffset + self.INDEX.size
+            self.pages = {}
+            for _ in range(pageCount):
+                page, offset, length, rawSize = self.PAGE_ENTRY.unpack_from(self.map, position)
+                self.pages[page] = (offset, length, rawSize)
+                position += self.PAGE_ENTRY.size
+            self.images = {}
+            for _ in range(imageCount):
+                key, offset, length = self.IMAGE_ENTRY.unpack_from(self.map, position)
+                self.images[key.decode("ascii")] = (offset, length)
+                position += self.IMAGE_ENTRY.size
+            self.styles = (stylesOffset, stylesLength)
+        except Exception:
+            self.close()
+            raise
+
+        self.size = len(self.map)
+        self.liveBytes = (self.HEADER.size + indexLength + stylesLength
+                          + sum(entry[1] for entry in self.pages.values())
+                          + sum(entry[1] for entry in self.images.values()))
+
+    def read(self, offset, length):
+        return self.map[offset:offset + length]
+
+    def readStyles(self):
+        offset, length = self.styles
+        if not length:
+            return {}
+        return json.loads(zlib.decompress(self.read(offset, length)).decode("utf-8"))
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if not self.file.closed:
+            self.file.close()
+
+    @classmethod
+    def packIndex(cls, pages, images, styles):
+        parts = [cls.INDEX.pack(len(pages), len(images), *styles)]
+        for page in sorted(pages):
+            parts.append(cls.PAGE_ENTRY.pack(page, *pages[page]))
+        for key in sorted(images):
+            parts.append(cls.IMAGE_ENTRY.pack(key.encode("ascii"), *images[key]))
+        return b"".join(parts)
+
+    @classmethod
+    def save(cls, path, pages, images, styles, previous=None):
+        # pages: page -> (сжатый html, размер) либо None, если блок не изменился в previous;
+        # images: hash -> байты либо None. Возвращает заново открытый проект; previous закрывается, только
+        # если записан тот же файл и запись удалась, иначе он остаётся открытым у хранилищ страниц и картинок.
+        # Если ничего не изменилось, файл не трогается и возвращается previous.
+        path = os.path.abspath(path)
+        stylesData = zlib.compress(json.dumps(styles, ensure_ascii=False).encode("utf-8"))
+        if previous is not None and previous.path == path:
+            unchanged = (set(pages) == set(previous.pages) and set(images) == set(previous.images)
+                         and not any(pages.values()) and not any(images.values())
+                         and previous.read(*previous.styles) == stylesData)
+            if unchanged:
+                return previous
+        if previous is not None and previous.path == path and previous.liveBytes * 2 >= previous.size:
+            cls.append(path, pages, images, stylesData, previous)
+        else:
+            cls.rewrite(path, pages, images, stylesData, previous)
+        project = cls(path)
+        if previous is not None and previous.path == path:
+            previous.close()
+        return project
+
+    @classmethod
+    def append(cls, path, pages, images, stylesData, previous):
+        # Дописываем только изменённые блоки и новую таблицу, затем переключаем заголовок на неё
+        with open(path, "r+b") as file:
+            file.seek(0, os.SEEK_END)
+            pageEntries = {}
+            for page, block in pages.items():
+                if block is None:
+                    pageEntries[page] = previous.pages[page]
+                else:
+                    data, rawSize = block
+                    pageEntries[page] = (file.tell(), len(data), rawSize)
+                    file.write(data)
+            imageEntries = {}
+            for key, data in images.items():
+                if data is None:
+                    imageEntries[key] = previous.images[key]
+                else:
+                    imageEntries[key] = (file.tell(), len(data))
+                    file.write(data)
+            stylesEntry = previous.styles
+            if previous.read(*previous.styles) != stylesData:
+                stylesEntry = (file.tell(), len(stylesData))
+                file.write(stylesData)
+
+            index = cls.packIndex(pageEntries, imageEntries, stylesEntry)
+            indexOffset = file.tell()
+            file.write(index)
+            file.flush()
+            os.fsync(file.fileno())
+
+            file.seek(0)
+            file.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, 0, indexOffset, len(index)))
+            file.flush()
+            os.fsync(file.fileno())
+
+    @classmethod
+    def rewrite(cls, path, pages, images, stylesData, previous):
+        # Полная запись во временный файл рядом с целевым, затем атомарная замена
+        fd, tempPath = tempfile.mkstemp(prefix=".", suffix=cls.EXTENSION, dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(bytes(cls.HEADER.size))
+                pageEntries = {}
+                for page, block in pages.items():
+                    if block is None:
+                        offset, length, rawSize = previous.pages[page]
+                        block = (previous.read(offset, length), rawSize)
+                    data, rawSize = block
+                    pageEntries[page] = (file.tell(), len(data), rawSize)
+                    file.write(data)
+                imageEntries = {}
+                for key, data in images.items():
+                    if data is None:
+                        data = previous.read(*previous.images[key])
+                    imageEntries[key] = (file.tell(), len(data))
+                    file.write(data)
+                stylesEntry = (file.tell(), len(stylesData))
+                file.write(stylesData)
+
+                index = cls.packIndex(pageEntries, imageEntries, stylesEntry)
+                indexOffset = file.tell()
+                file.write(index)
+                file.seek(0)
+                file.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, 0, indexOffset, len(index)))
+                file.flush()
+                os.fsync(file.fileno())
+            replaceFile(tempPath, path)
+        except Exception:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise
+
+
+class PageStore(QObject):
+    dirtyChanged = pyqtSignal(int)
+    pageChanged = pyqtSignal(int)  # содержимое страницы изменилось
+
+    # Сколько страниц держим живыми QTextDocument (с историей правок)
+    HOT_PAGES = 8
+    # Сколько байт сжатых неактивных страниц держим в памяти, остальное уходит во временный файл
+    MEMORY_BUDGET = 64 * 1024 * 1024
+    COMPRESSION_LEVEL = 6
+    # Сколько соседних страниц с каждой стороны извлекаем заранее
+    PREFETCH_PAGES = 2
+
+    def __init__(self, createDocument, hotLimit=HOT_PAGES, memoryBudget=MEMORY_BUDGET, parent=None):
+        super().__init__(parent)
+        self.createDocument = createDocument
+        self.hotLimit = max(1, hotLimit)
+        self.memoryBudget = memoryBudget
+        self.hot = OrderedDict()  # page -> QTextDocument, от давно использованных к недавним
+        self.cold = OrderedDict()  # page -> (сжатый html, размер html в байтах)
+        self.spilled = {}  # page -> (смещение, длина, размер html в байтах) во временном файле
+        self.mapped = {}  # page -> (смещение, длина, размер html в байтах) в файле проекта
+        self.project = None
+        self.coldBytes = 0
+        self.spillFile = None
+        self.pinned = None
+        self.stale = set()  # открытые страницы, для которых сжатая копия устарела
+        self.dirty = set()  # страницы, изменённые с последнего сохранения
+        self.versions = {}  # page -> номер правки
+        self.versionCounter = count(1)
+        self.pending = {}  # page -> (источник, номер страницы в источнике), ещё не извлечённые страницы
+        self.sources = []
+        self.plainTexts = {}  # page -> (версия, текст) для поиска по всем страницам
+        self.prefetchQueue = []
+        self.prefetchTimer = QTimer(self)
+        self.prefetchTimer.timeout.connect(self.prefetchNext)
+
+    def document(self, page):
+        document = self.hot.get(page)
+        if document is not None:
+            self.hot.move_to_end(page)
+            return document
+
+        document = self.createDocument()
+        # Сжатая копия остаётся в хранилище, пока страница не изменится
+        html = self.readCold(page)
+        if html:
+            document.setHtml(html)
+        document.setModified(page in self.dirty)
+        self.connectDocument(page, document)
+        self.hot[page] = document
+        self.evict()
+        return document
+
+    def replaceDocument(self, page, document):
+        # Документ, собранный вне редактора (например, при загрузке файла), становится документом страницы
+        self.hot.pop(page, None)
+        self.dropCold(page)
+        self.connectDocument(page, document)
+        self.hot[page] = document
+        document.setModified(True)
+        self.onContentsChanged(page)
+        self.evict()
+
+    def putCompressed(self, page, data, rawSize):
+        # Страница, собранная вне редактора и уже сжатая, кладётся сразу в холодное хранилище
+        document = self.hot.get(page)
+        if document is not None:
+            document.setHtml(zlib.decompress(data).decode("utf-8"))
+            document.setModified(True)
+            self.stale.discard(page)
+        self.storeCompressed(page, data, rawSize)
+        self.versions[page] = next(self.versionCounter)
+        self.dirty.add(page)
+        self.dirtyChanged.emit(len(self.dirty))
+
+    def attachSource(self, source, firstPage=1):
+        # Страницы источника занимают номера, начиная с firstPage, но извлекаются только
+        # при первом обращении; в проект они ещё не сохранены, поэтому сразу считаются изменёнными
+        self.sources.append(source)
+        for index in range(source.pageCount):
+            page = firstPage + index
+            self.hot.pop(page, None)
+            self.dropCold(page)
+            self.stale.discard(page)
+            self.pending[page] = (source, index)
+            self.versions[page] = next(self.versionCounter)
+            self.dirty.add(page)
+        self.dirtyChanged.emit(len(self.dirty))
+
+    def materialize(self, page):
+        source, index = self.pending.pop(page)
+        self.storeCold(page, source.pageHtml(index))
+
+    def pendingBySource(self):
+        # Ещё не извлечённые страницы для MaterializeThread: [(источник, {номер в источнике: страница})]
+        groups = []
+        for source in self.sources:
+            pages = {index: page for page, (pageSource, index) in self.pending.items() if pageSource is source}
+            if pages:
+                groups.append((source, pages))
+        return groups
+
+    def storeExtracted(self, page, source, index, html):
+        # Пока страница извлекалась в фоне, её могли открыть в редакторе или заменить другой
+        if self.pending.get(page) == (source, index):
+            del self.pending[page]
+            self.storeCold(page, html)
+
+    def schedulePrefetch(self, page):
+        # Соседние страницы извлекаем заранее, по одной за итерацию цикла событий
+        self.prefetchQueue = []
+        for offset in range(1, self.PREFETCH_PAGES + 1):
+            self.prefetchQueue += [page + offset, page - offset]
+        if any(page in self.pending for page in self.prefetchQueue):
+            self.prefetchTimer.start(0)
+
+    def prefetchNext(self):
+        while self.prefetchQueue:
+            page = self.prefetchQueue.pop(0)
+            if page in self.pending:
+                self.materialize(page)
+                break
+        if not self.prefetchQueue:
+            self.prefetchTimer.stop()
+
+    def connectDocument(self, page, document):
+        # contentsChange приходит только от документов с раскладкой, contentsChanged — от любых
+        document.contentsChanged.connect(partial(self.onContentsChanged, page))
+        document.modificationChanged.connect(partial(self.onModificationChanged, page))
+
+    def onContentsChanged(self, page):
+        self.stale.add(page)
+        self.versions[page] = next(self.versionCounter)
+        self.pageChanged.emit(page)
+        # После отмены правок до сохранённого состояния документ уже не изменён
+        document = self.hot.get(page)
+        if page not in self.dirty and (document is None or document.isModified()):
+            self.dirty.add(page)
+            self.dirtyChanged.emit(len(self.dirty))
+
+    def onModificationChanged(self, page, modified):
+        # Отмена правок до сохранённого состояния снимает отметку. setPlainText/setHtml редактора
+        # тоже сбрасывают флаг изменения, но при этом очищают историю — такой сброс не считаем
+        document = self.hot.get(page)
+        if modified or page not in self.dirty or document is None:
+            return
+        if document.isUndoAvailable() or document.isRedoAvailable():
+            self.dirty.discard(page)
+            self.dirtyChanged.emit(len(self.dirty))
+
+    def markClean(self, pages=None):
+        pages = self.keys() if pages is None else pages
+        for page in pages:
+            self.dirty.discard(page)
+            if page in self.hot:
+                self.hot[page].setModified(False)
+        self.dirtyChanged.emit(len(self.dirty))
+
+    def dirtyPages(self):
+        return sorted(self.dirty)
+
+    def version(self, page):
+        return self.versions.get(page, 0)
+
+    def pin(self, page):
+        # Страница, показанная в редакторе, не вытесняется
+        self.pinned = page
+        self.evict()
+        self.schedulePrefetch(page)
+
+    def evict(self):
+        # Самую свежую страницу не трогаем: её документ только что запросили
+        for page in list(self.hot)[:-1]:
+            if len(self.hot) <= self.hotLimit:
+                break
+            if page == self.pinned:
+                continue
+            document = self.hot.pop(page)
+            if page in self.stale or not self.hasCold(page):
+                self.storeCold(page, document.toHtml())
+                self.stale.discard(page)
+
+    def storeCold(self, page, html):
+        raw = html.encode("utf-8")
+        self.storeCompressed(page, zlib.compress(raw, self.COMPRESSION_LEVEL), len(raw))
+
+    def storeCompressed(self, page, data, rawSize):
+        self.dropCold(page)
+        self.cold[page] = (data, rawSize)
+        self.coldBytes += len(data)
+        self.spill()
+
+    def spill(self):
+        # Сбрасываем давно не использованные страницы во временный файл, пока не уложимся в бюджет
+        while self.coldBytes > self.memoryBudget and self.cold:
+            page, (data, rawSize) = self.cold.popitem(last=False)
+            self.coldBytes -= len(data)
+            if self.spillFile is None:
+                self.spillFile = tempfile.TemporaryFile(prefix="pages-")
+            self.spillFile.seek(0, 2)
+            self.spilled[page] = (self.spillFile.tell(), len(data), rawSize)
+            self.spillFile.write(data)
+
+    def hasCold(self, page):
+        return page in self.cold or page in self.spilled or page in self.mapped or page in self.pending
+
+    def dropCold(self, page):
+        entry = self.cold.pop(page, None)
+        if entry is not None:
+            self.coldBytes -= len(entry[0])
+        self.spilled.pop(page, None)
+        self.mapped.pop(page, None)
+        self.pending.pop(page, None)
+
+    def compressed(self, page):
+        # Сжатый html страницы в том виде, в котором он хранится: (данные, размер html в байтах)
+        if page in self.pending:
+            self.materialize(page)
+        if page in self.hot and (page in self.stale or not self.hasCold(page)):
+            self.html(page)
+        if page in self.cold:
+            return self.cold[page]
+        if page in self.spilled:
+            offset, length, rawSize = self.spilled[page]
+            self.spillFile.seek(offset)
+            return self.spillFile.read(length), rawSize
+        if page in self.mapped:
+            offset, length, rawSize = self.mapped[page]
+            return self.project.read(offset, length), rawSize
+        return zlib.compress(b"", self.COMPRESSION_LEVEL), 0
+
+    def readCold(self, page):
+        if page in self.pending:
+            self.materialize(page)
+        if not self.hasCold(page):
+            return None
+        return zlib.decompress(self.compressed(page)[0]).decode("utf-8")
+
+    def attachProject(self, project):
+        # Сохранённые в проекте страницы читаются прямо из отображённого в память файла
+        if self.project is not None and self.project is not project:
+            self.project.close()
+        self.project = project
+        for page, entry in project.pages.items():
+            if page in self.stale:
+                self.mapped.pop(page, None)
+                continue
+            self.dropCold(page)
+            self.mapped[page] = entry
+            self.versions.setdefault(page, next(self.versionCounter))
+
+    def reset(self, project=None):
+        self.hot.clear()
+        self.cold.clear()
+        self.coldBytes = 0
+        self.stale.clear()
+        self.dirty.clear()
+        self.versions.clear()
+        self.plainTexts.clear()
+        self.pinned = None
+        self.close()
+        if project is not None:
+            self.attachProject(project)
+        self.dirtyChanged.emit(0)
+
+    def html(self, page):
+        # Сериализуем только изменённые страницы, остальные берём из сжатой копии
+        if page in self.hot and (page in self.stale or not self.hasCold(page)):
+            html = self.hot[page].toHtml()
+            self.storeCold(page, html)
+            self.stale.discard(page)
+            return html
+        return self.readCold(page) or ""
+
+    def plainText(self, page):
+        # Текст страницы для поиска; позиции в нём совпадают с позициями в документе страницы
+        version = self.version(page)
+        cached = self.plainTexts.get(page)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        document = self.hot.get(page)
+        if document is None:
+            document = QTextDocument()
+            document.setHtml(self.readCold(page) or "")
+        text = document.toPlainText()
+        self.plainTexts[page] = (version, text)
+        return text
+
+    def get(self, page, default=""):
+        if page in self:
+            return self.html(page)
+        return default
+
+    def keys(self):
+        return sorted(set(self.hot) | set(self.cold) | set(self.spilled) | set(self.mapped) | set(self.pending))
+
+    def pageStats(self):
+        stats = []
+        for page in self.keys():
+            item = {"page": page, "state": None, "chars": None, "raw": None, "stored": None,
+                    "dirty": page in self.dirty}
+            if page in self.cold:
+                data, item["raw"] = self.cold[page]
+                item["state"], item["stored"] = "cold", len(data)
+            elif page in self.spilled:
+                _, item["stored"], item["raw"] = self.spilled[page]
+                item["state"] = "spilled"
+            elif page in self.mapped:
+                _, item["stored"], item["raw"] = self.mapped[page]
+                item["state"] = "mapped"
+            elif page in self.pending:
+                item["state"] = "pending"
+            if page in self.hot:
+                item["state"], item["chars"] = "hot", self.hot[page].characterCount()
+            stats.append(item)
+        return stats
+
+    def spilledBytes(self):
+        return sum(length for _, length, _ in self.spilled.values())
+
+    def close(self):
+        if self.spillFile is not None:
+            self.spillFile.close()
+            self.spillFile = None
+        self.spilled.clear()
+        if self.project is not None:
+            self.project.close()
+            self.project = None
+        self.mapped.clear()
+        self.prefetchTimer.stop()
+        self.prefetchQueue = []
+        self.pending.clear()
+        for source in self.sources:
+            source.close()
+        self.sources = []
+
+    def __getitem__(self, page):
+        if page not in self:
+            raise KeyError(page)
+        return self.html(page)
+
+    def __setitem__(self, page, html):
+        if page in self.hot:
+            self.hot[page].setHtml(html)
+        else:
+            self.versions[page] = next(self.versionCounter)
+            self.dirty.add(page)
+            self.dirtyChanged.emit(len(self.dirty))
+        self.storeCold(page, html)
+        self.stale.discard(page)
+
+    def __contains__(self, page):
+        return page in self.hot or self.hasCold(page)
+
+    def __len__(self):
+        return len(self.keys())
+
+
+class WordIndex(QObject):
+    # Обратный индекс слов: слово -> страницы, страница -> {слово: смещения в тексте страницы}.
+    # Страница переиндексируется, когда меняется её версия в PageStore: после правок в фоне с задержкой,
+    # при уходе со страницы и перед поиском. Рядом с файлом проекта индекс хранится в файле .idx
+    # блоками по страницам, как сам проект: блок привязан к контрольной сумме блока страницы в проекте,
+    # при сохранении дописываются только изменившиеся страницы, а читается файл при первом поиске
+    WORD = re.compile(r"\w+")
+    SUFFIX = ".idx"
+    REINDEX_DELAY = 1000  # мс после правки
+    MAGIC = b"SIDX"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHHQQ")  # сигнатура, версия, резерв, смещение и длина таблицы
+    ENTRY = struct.Struct("<IIIIQI")  # страница, crc32, длина и размер html блока в проекте, смещение, длина
+    BLOCK = struct.Struct("<II")  # число слов, длина слов в байтах; дальше числа и смещения вхождений
+
+    def __init__(self, pageStore, parent=None):
+        super().__init__(parent)
+        self.pageStore = pageStore
+        self.pageWords = {}  # page -> (версия, {слово: array смещений})
+        self.termPages = {}  # слово -> множество страниц
+        self.sortedTerms = None  # для поиска по началу слова, строится при первом запросе
+        self.changed = set()
+        self.project = None
+        self.savedVersions = {}  # page -> версия страницы, совпадающая с её блоком в проекте
+        self.blockCrcs = {}  # (файл, смещение, длина) блока страницы в проекте -> crc32
+        self.stored = None  # page -> запись таблицы файла .idx, читается при первом обращении
+        self.storedLoaded = False
+        self.reindexTimer = QTimer(self)
+        self.reindexTimer.setSingleShot(True)
+        self.reindexTimer.setInterval(self.REINDEX_DELAY)
+        self.reindexTimer.timeout.connect(self.reindexChanged)
+        pageStore.pageChanged.connect(self.onPageChanged)
+
+    def onPageChanged(self, page):
+        self.changed.add(page)
+        self.reindexTimer.start()
+
+    def reindexChanged(self):
+        self.reindexTimer.stop()
+        for page in self.changed:
+            if page in self.pageStore:
+                self.indexPage(page)
+        self.changed.clear()
+
+    def indexPage(self, page):
+        version = self.pageStore.version(page)
+        entry = self.pageWords.get(page)
+        if entry is not None and entry[0] == version:
+            return
+        self.dropPage(page)
+        words = {}
+        for match in self.WORD.finditer(self.pageStore.plainText(page)):
+            offsets = words.get(match.group())
+            if offsets is None:
+                offsets = words[match.group()] = array('Q')
+            offsets.append(match.start())
+        self.addPage(page, version, words)
+
+    def addPage(self, page, version, words):
+        self.pageWords[page] = (version, words)
+        for term in words:
+            pages = self.termPages.get(term)
+            if pages is None:
+                pages = self.termPages[term] = set()
+                self.sortedTerms = None
+            pages.add(page)
+
+    def dropPage(self, page):
+        entry = self.pageWords.pop(page, None)
+        if entry is None:
+            return
+        for term in entry[1]:
+            pages = self.termPages[term]
+            pages.discard(page)
+            if not pages:
+                del self.termPages[term]
+                self.sortedTerms = None
+
+    def refresh(self):
+        # Переиндексируются только страницы, изменившиеся с прошлого раза
+        self.loadStored()
+        pages = set(self.pageStore.keys())
+        for page in [page for page in self.pageWords if page not in pages]:
+            self.dropPage(page)
+        for page in sorted(pages):
+            self.indexPage(page)
+        self.changed.clear()
+
+    def find(self, word, prefix=False):
+        # Совпадения слова или слов с этим началом: [(страница, начало, конец)] в символах текста страницы
+        self.refresh()
+        if prefix:
+            if self.sortedTerms is None:
+                self.sortedTerms = sorted(self.termPages)
+            first = bisect_left(self.sortedTerms, word)
+            last = bisect_left(self.sortedTerms, word + "\U0010ffff", first)
+            terms = self.sortedTerms[first:last]
+        else:
+            terms = [word] if word in self.termPages else []
+        # Как и при просмотре страниц регулярным выражением, совпадение — само искомое начало слова
+        hits = []
+        for term in terms:
+            for page in self.termPages[term]:
+                hits.extend((page, offset, offset + len(word)) for offset in self.pageWords[page][1][term])
+        hits.sort()
+        return hits
+
+    def reset(self):
+        self.pageWords.clear()
+        self.termPages.clear()
+        self.sortedTerms = None
+        self.changed.clear()
+        self.reindexTimer.stop()
+        self.project = None
+        self.savedVersions = {}
+        self.blockCrcs.clear()
+        self.stored = None
+        self.storedLoaded = False
+
+    def attach(self, project):
+        # Страницы только что открытого или сохранённого проекта совпадают с его блоками;
+        # сам файл .idx здесь не читается
+        self.project = project
+        self.savedVersions = {page: self.pageStore.version(page) for page in project.pages
+                              if page not in self.pageStore.dirty}
+        self.stored = None
+        self.storedLoaded = False
+
+    def path(self):
+        return self.project.path + self.SUFFIX
+
+    def blockKey(self, page):
+        # Версия страницы на диске: crc32, длина и размер html её блока в проекте. Блоки только дописываются
+        # в конец файла, так что в одном файле блок на том же месте не меняется и crc32 считается один раз
+        offset, length, rawSize = self.project.pages[page]
+        key = (os.fstat(self.project.file.fileno()).st_ino, offset, length)
+        crc = self.blockCrcs.get(key)
+        if crc is None:
+            crc = self.blockCrcs[key] = zlib.crc32(self.project.read(offset, length))
+        return crc, length, rawSize
+
+    def readTable(self):
+        # Таблица файла .idx: page -> (crc32, длина, размер html, смещение, длина блока индекса)
+        if self.stored is not None:
+            return self.stored
+        self.stored = {}
+        try:
+            with open(self.path(), "rb") as file:
+                magic, version, _, tableOffset, tableLength = self.HEADER.unpack(file.read(self.HEADER.size))
+                if magic != self.MAGIC or version != self.VERSION:
+                    return self.stored
+                file.seek(tableOffset)
+                table = file.read(tableLength)
+            for position in range(0, len(table) - len(table) % self.ENTRY.size, self.ENTRY.size):
+                entry = self.ENTRY.unpack_from(table, position)
+                self.stored[entry[0]] = entry[1:]
+        except (OSError, struct.error):
+            self.stored = {}
+        return self.stored
+
+    def loadStored(self):
+        # Первый поиск после открытия: берём из файла .idx страницы, не менявшиеся с сохранения
+        if self.storedLoaded or self.project is None:
+            return
+        self.storedLoaded = True
+        stored = self.readTable()
+        if not stored:
+            return
+        try:
+            with open(self.path(), "rb") as file:
+                for page, entry in sorted(stored.items(), key=lambda item: item[1][3]):
+                    version = self.pageStore.version(page)
+                    if page not in self.project.pages or self.savedVersions.get(page) != version:
+                        continue
+                    indexed = self.pageWords.get(page)
+                    if indexed is not None and indexed[0] == version or entry[:3] != self.blockKey(page):
+                        continue
+                    file.seek(entry[3])
+                    words = self.unpackWords(file.read(entry[4]))
+                    self.dropPage(page)
+                    self.addPage(page, version, words)
+        except (OSError, ValueError, struct.error, zlib.error):
+            pass  # остальные страницы проиндексируются заново
+
+    @classmethod
+    def packWords(cls, words):
+        terms = list(words)
+        counts = array('I', (len(words[term]) for term in terms))
+        offsets = array('Q')
+        for term in terms:
+            offsets.extend(words[term])
+        termData = "\n".join(terms).encode("utf-8")
+        return zlib.compress(cls.BLOCK.pack(len(terms), len(termData)) + termData
+                             + counts.tobytes() + offsets.tobytes())
+
+    @classmethod
+    def unpackWords(cls, data):
+        data = memoryview(zlib.decompress(data))
+        termCount, termLength = cls.BLOCK.unpack_from(data, 0)
+        position = cls.BLOCK.size
+        terms = str(data[position:position + termLength], "utf-8").split("\n") if termCount else []
+        position += termLength
+        counts = array('I')
+        counts.frombytes(data[position:position + termCount * counts.itemsize])
+        offsets = array('Q')
+        offsets.frombytes(data[position + termCount * counts.itemsize:])
+        if len(terms) != termCount or sum(counts) != len(offsets):
+            raise ValueError("повреждённый блок индекса")
+        words = {}
+        start = 0
+        for term, number in zip(terms, counts):
+            words[term] = offsets[start:start + number]
+            start += number
+        return words
+
+    def save(self, project):
+        # Вызывается после сохранения проекта: блоки страниц, чей текст в проекте не менялся, остаются
+        # на месте, дописываются только проиндексированные страницы с новым содержимым
+        samePath = self.project is not None and self.project.path == project.path
+        stored = self.readTable() if samePath else {}
+        self.attach(project)
+        self.stored = stored
+        entries = {}
+        blocks = {}
+        for page in project.pages:
+            key = self.blockKey(page)
+            entry = stored.get(page)
+            if entry is not None and entry[:3] == key:
+                entries[page] = entry
+                continue
+            indexed = self.pageWords.get(page)
+            if indexed is not None and self.savedVersions.get(page) == indexed[0]:
+                blocks[page] = (key, self.packWords(indexed[1]))
+        if not blocks and entries.keys() == stored.keys():
+            return
+
+        path = self.path()
+        liveBytes = self.HEADER.size + sum(entry[4] for entry in entries.values())
+        try:
+            size = os.path.getsize(path) if stored else 0
+        except OSError:
+            size = 0
+        if stored and liveBytes * 2 >= size:
+            self.append(path, entries, blocks)
+        else:
+            self.rewrite(path, entries, blocks)
+        self.stored = entries
+
+    def packTable(self, entries):
+        return b"".join(self.ENTRY.pack(page, *entries[page]) for page in sorted(entries))
+
+    def append(self, path, entries, blocks):
+        # Как ProjectFile.append: новые блоки и таблица в конец, затем заголовок переключается на таблицу
+        with open(path, "r+b") as file:
+            file.seek(0, os.SEEK_END)
+            for page, (key, data) in blocks.items():
+                entries[page] = key + (file.tell(), len(data))
+                file.write(data)
+            table = self.packTable(entries)
+            tableOffset = file.tell()
+            file.write(table)
+            file.flush()
+            os.fsync(file.fileno())
+
+            file.seek(0)
+            file.write(self.HEADER.pack(self.MAGIC, self.VERSION, 0, tableOffset, len(table)))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def rewrite(self, path, entries, blocks):
+        # Полная запись во временный файл: живые блоки старого файла переписываются подряд
+        fd, tempPath = tempfile.mkstemp(prefix=".", suffix=self.SUFFIX, dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(bytes(self.HEADER.size))
+                if entries:
+                    with open(path, "rb") as source:
+                        for page, entry in entries.items():
+                            source.seek(entry[3])
+                            data = source.read(entry[4])
+                            entries[page] = entry[:3] + (file.tell(), len(data))
+                            file.write(data)
+                for page, (key, data) in blocks.items():
+                    entries[page] = key + (file.tell(), len(data))
+                    file.write(data)
+                table = self.packTable(entries)
+                tableOffset = file.tell()
+                file.write(table)
+                file.seek(0)
+                file.write(self.HEADER.pack(self.MAGIC, self.VERSION, 0, tableOffset, len(table)))
+            replaceFile(tempPath, path)
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+
+
 class MyWidget(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -353,7 +3458,40 @@ class MyWidget(QMainWindow):
         self.toolBar.addWidget(self.pages)
 
         self.pages.valueChanged.connect(self.change_page)
-        self.page_contents = {}  # Хранение содержимого страниц
+        self.images = ImageStore()
+        self.exportThread = None
+        self.findDialog = None
+        self.materializeThread = None
+        self.afterMaterialize = []
+        self.exportWorkers = os.cpu_count() or 1
+        self.renderCache = RenderCache()
+        self.pdfHtmlCache = PdfHtmlCache()
+        self.importCache = ImportCache()
+        self.page_contents = PageStore(self.createPageDocument, parent=self)  # Хранение содержимого страниц
+        self.matchHighlighter = MatchHighlighter(self.textEdit, self)
+        self.wordIndex = WordIndex(self.page_contents, self)
+        self.dirtyLabel = QLabel()
+        self.statusbar.addPermanentWidget(self.dirtyLabel)
+        self.importers = {  # формат из detectFileFormat -> способ открытия
+            "project": self.openProject,
+            "text": self.openTextFile,
+            "docx": self.openDocxFile,
+            "pdf": self.openPdfFile,
+        }
+        self.importThread = None
+        self.importDelivered = False  # первая страница загружаемого файла уже пришла
+        self.importFirstPage = 1
+        self.loadPlaceholder = None
+        self.loadProgress = QProgressBar()
+        self.loadProgress.setRange(0, 100)
+        self.loadProgress.setMaximumWidth(200)
+        self.loadProgress.hide()
+        self.statusbar.addPermanentWidget(self.loadProgress)
+        self.loadCancelButton = QPushButton("Отмена")
+        self.loadCancelButton.hide()
+        self.loadCancelButton.clicked.connect(self.cancelLoading)
+        self.statusbar.addPermanentWidget(self.loadCancelButton)
+        self.page_contents.dirtyChanged.connect(self.updateDirtyLabel)
         self.current_page = 1
         self.pages.setMinimum(1)
         self.pages.setValue(1)
@@ -398,6 +3536,29 @@ class MyWidget(QMainWindow):
         self.actionReplace.triggered.connect(self.replaceWindow)
         self.actionInsert_new.triggered.connect(self.insert)
 
+        self.actionSaveProject = QAction("Save Project", self)
+        self.actionSaveProject.setShortcut("CTRL+SHIFT+S")
+        self.actionSaveProject.triggered.connect(self.saveProject)
+        self.actionSaveProjectAs = QAction("Save Project As...", self)
+        self.actionSaveProjectAs.triggered.connect(self.saveProjectAs)
+        self.menuFile.insertActions(self.actionSave_2, [self.actionSaveProject, self.actionSaveProjectAs])
+
+        self.actionPdfFormatting = QAction("Keep PDF Formatting", self)
+        self.actionPdfFormatting.setCheckable(True)
+        self.menuFile.insertAction(self.actionSaveProject, self.actionPdfFormatting)
+
+        self.actionExportDocx = QAction("Export DOCX...", self)
+        self.actionExportDocx.triggered.connect(self.saveAsDocx)
+        self.menuFile.insertAction(self.actionPrint_2, self.actionExportDocx)
+
+        self.actionExportWorkers = QAction("PDF Export Workers...", self)
+        self.actionExportWorkers.triggered.connect(self.setExportWorkers)
+        self.menuFile.insertAction(self.actionPrint_2, self.actionExportWorkers)
+
+        self.actionMemoryStats = QAction("Memory usage", self)
+        self.actionMemoryStats.triggered.connect(self.showMemoryStats)
+        self.menuEdit.addAction(self.actionMemoryStats)
+
         self.actionBold.setShortcut(QKeySequence.Bold)
         self.actionBold.setCheckable(True)
         self.actionBold.toggled.connect(lambda x: self.textEdit.setFontWeight(QFont.Bold if x else QFont.Normal))
@@ -481,8 +3642,11 @@ class MyWidget(QMainWindow):
         file_name, _ = QFileDialog.getOpenFileName(self, 'Выбрать изображение', '',
                                                    'Изображения (*.png *.jpg *.bmp *.gif)')
         if file_name:
+            # Изображение хранится в проекте один раз, документ ссылается на него по хэшу
+            with open(file_name, 'rb') as file:
+                key = self.images.add(file.read())
             cursor = self.textEdit.textCursor()
-            cursor.insertHtml('<img src="{}">'.format(file_name))
+            cursor.insertHtml('<img src="{}">'.format(ImageStore.url(key)))
 
     def fileNew(self):
         result = QMessageBox.question(
@@ -502,77 +3666,392 @@ class MyWidget(QMainWindow):
             return
 
     def save_as_pdf(self):
-        # Сначала сохраняем текущую страницу
-        self.page_contents[self.current_page] = self.textEdit.toHtml()
+        if self.isExporting():
+            return
 
         file_path, _ = QFileDialog.getSaveFileName(self, "Save File", "", "PDF Files (*.pdf)")
         if file_path:
-            try:
-                printer = QPrinter(QPrinter.HighResolution)
-                printer.setOutputFormat(QPrinter.PdfFormat)
-                printer.setOutputFileName(file_path)
-
-                # Создаем новый документ для финального PDF
-                final_document = QTextDocument()
+            self.materializePages(partial(self.exportPdf, file_path))
 
-                # Объединяем содержимое всех страниц в один HTML документ
-                full_html = "<html><body>"
-                for page in sorted(self.page_contents.keys()):
-                    text = self.page_contents.get(page, "")
-                    if page != min(self.page_contents.keys()):  # Добавляем разрыв страницы между страницами
-                        full_html += "<div style='page-break-before:always;'></div>"
-                    full_html += f"<div>{text}</div>"
+    def exportPdf(self, file_path):
+        if not self.isExporting():
+            self.startExport(PdfExportThread(file_path, self.pageSnapshot(), self.images.snapshot(),
+                                             self.exportWorkers, self.renderCache, self))
 
-                full_html += "</body></html>"
-
-                final_document.setHtml(full_html)
-                final_document.print_(printer)
-                QMessageBox.information(self, "Сохранение завершено", f"Документ сохранен по пути {file_path}")
+    def saveAsDocx(self):
+        if self.isExporting():
+            return
 
-            except Exception as e:
-                QMessageBox.critical(self, "Ошибка сохранения", f"Произошла ошибка при сохранении PDF: {str(e)}")
+        file_path, _ = QFileDialog.getSaveFileName(self, "Export DOCX", "", "Word Documents (*.docx)")
+        if file_path:
+            if not file_path.endswith('.docx'):
+                file_path += '.docx'
+            self.materializePages(partial(self.exportDocx, file_path))
+
+    def exportDocx(self, file_path):
+        if not self.isExporting():
+            self.startExport(DocxExportThread(file_path, self.pageSnapshot(), self.images.snapshot(), self))
+
+    def isExporting(self):
+        if self.exportThread is not None and self.exportThread.isRunning():
+            QMessageBox.information(self, "Сохранение", "Сохранение уже выполняется")
+            return True
+        return False
+
+    def pageSnapshot(self):
+        return [self.page_contents.compressed(page) for page in self.page_contents.keys()]
+
+    def materializePages(self, then):
+        # Страницы, ещё не извлечённые из открытого файла, извлекаются в фоновом потоке с прогрессом;
+        # then вызывается в потоке GUI, когда все страницы на месте
+        if not self.page_contents.pending:
+            then()
+            return
+        self.afterMaterialize.append(then)
+        if self.materializeThread is not None:
+            return
+        thread = MaterializeThread(self.page_contents.pendingBySource(), self.exportWorkers, self)
+        self.materializeThread = thread
+        self.materializeProgress = QProgressDialog("Извлечение страниц...", "Отмена", 0, thread.total, self)
+        self.materializeProgress.setWindowModality(Qt.NonModal)
+        self.materializeProgress.canceled.connect(thread.requestInterruption)
+        thread.progress.connect(self.onMaterializeProgress)
+        thread.pageReady.connect(self.page_contents.storeExtracted)
+        thread.finished.connect(self.onMaterializeFinished)
+        thread.start()
+
+    def onMaterializeProgress(self, done, total):
+        self.materializeProgress.setValue(done)
+        self.statusbar.showMessage(f"Извлечение страниц: {done} из {total}")
+
+    def onMaterializeFinished(self):
+        thread = self.materializeThread
+        callbacks = self.afterMaterialize
+        self.closeMaterialize()
+        if thread.error is not None:
+            QMessageBox.critical(self, "Ошибка", f"Не удалось извлечь страницы: {str(thread.error)}")
+        elif thread.cancelled:
+            self.statusbar.showMessage("Извлечение страниц отменено", 5000)
+        else:
+            # За время извлечения могли добавиться новые страницы: тогда извлекаются и они
+            for then in callbacks:
+                self.materializePages(then)
+
+    def stopMaterialize(self):
+        # Источники страниц закрываются при сбросе хранилища, поэтому поток извлечения дожидаемся
+        thread = self.materializeThread
+        if thread is None:
+            return
+        thread.pageReady.disconnect()
+        thread.finished.disconnect()
+        thread.requestInterruption()
+        thread.wait()
+        self.closeMaterialize()
+
+    def closeMaterialize(self):
+        self.materializeThread.progress.disconnect()
+        self.materializeThread.deleteLater()
+        self.materializeThread = None
+        self.afterMaterialize = []
+        self.materializeProgress.canceled.disconnect()
+        self.materializeProgress.close()
+        self.statusbar.clearMessage()
+
+    def startExport(self, thread):
+        # Экспорт идёт в отдельном потоке по снимку страниц, редактор остаётся доступен
+        self.exportThread = thread
+        self.exportProgress = QProgressDialog(f"Сохранение {os.path.basename(thread.filePath)}...", "Отмена",
+                                              0, len(thread.pages), self)
+        self.exportProgress.setWindowModality(Qt.NonModal)
+        self.exportProgress.canceled.connect(thread.requestInterruption)
+        thread.progress.connect(self.onExportProgress)
+        thread.finished.connect(self.onExportFinished)
+        thread.start()
+
+    def setExportWorkers(self):
+        workers, ok = QInputDialog.getInt(self, "Экспорт PDF", "Число процессов для экспорта:",
+                                          self.exportWorkers, 1, 256)
+        if ok:
+            self.exportWorkers = workers
+
+    def onExportProgress(self, done, total):
+        self.exportProgress.setValue(done)
+        self.statusbar.showMessage(f"Сохранение: {done} из {total}")
+
+    def onExportFinished(self):
+        thread = self.exportThread
+        self.exportProgress.canceled.disconnect()
+        self.exportProgress.close()
+        self.statusbar.clearMessage()
+        if thread.error is not None:
+            QMessageBox.critical(self, "Ошибка сохранения", f"Произошла ошибка при сохранении: {str(thread.error)}")
+        elif thread.cancelled:
+            self.statusbar.showMessage("Сохранение отменено", 5000)
+        else:
+            QMessageBox.information(self, "Сохранение завершено", f"Документ сохранен по пути {thread.filePath}")
 
     def change_page(self):
-        # Сохраняем содержимое и формат текущей страницы
-        self.page_contents[self.current_page] = self.textEdit.toHtml()
-
-        # Меняем страницу
+        # Документ текущей страницы остаётся в хранилище вместе с историей правок,
+        # поэтому просто меняем страницу; правки покидаемой страницы сразу попадают в индекс
+        self.wordIndex.reindexChanged()
         self.current_page = self.pages.value()
         self.load_page_content()
 
     def load_page_content(self):
-        # Загружаем содержимое и формат для текущей страницы
-        text = self.page_contents.get(self.current_page, "")
-        self.textEdit.setHtml(text)
+        # Подставляем в редактор документ текущей страницы без сериализации в HTML
+        self.textEdit.setDocument(self.page_contents.document(self.current_page))
+        self.matchHighlighter.documentChanged()
+        self.page_contents.pin(self.current_page)
+
+    def updateDirtyLabel(self, count):
+        self.dirtyLabel.setText(f"Изменено страниц: {count}" if count else "")
+
+    def showPage(self, page):
+        if self.pages.value() != page:
+            self.pages.setValue(page)
+        else:
+            self.current_page = page
+            self.load_page_content()
+
+    def createPageDocument(self):
+        return self.pageDocumentFactory()()
+
+    def pageDocumentFactory(self):
+        # Настройки редактора читаются здесь, в потоке GUI, а документы по ним можно создавать в любом потоке
+        return partial(PageDocument.create, self.images, QFont(self.textEdit.font()), self.textEdit.tabStopDistance())
 
     def openFile(self):
         filePath, _ = QFileDialog.getOpenFileName(self, 'Open File', '',
-                                                  'Text Files (*.txt);;Word Documents (*.docx);;PDF Files (*.pdf);;All Files (*)')
+                                                  f'Project Files (*{ProjectFile.EXTENSION});;Text Files (*.txt);;'
+                                                  'Word Documents (*.docx);;PDF Files (*.pdf);;All Files (*)')
+        if filePath:
+            self.openPath(filePath)
+
+    def openPath(self, filePath):
+        try:
+            fileFormat, encoding = detectFileFormat(filePath)
+        except OSError as e:
+            QMessageBox.critical(self, "Ошибка", f"Не удалось открыть файл: {str(e)}")
+            return
+        importer = self.importers.get(fileFormat)
+        if importer is None:
+            QMessageBox.critical(self, "Ошибка", f"Неизвестный формат файла: {os.path.basename(filePath)}")
+            return
+        if encoding is not None:
+            importer = partial(importer, encoding=encoding)
+        importer(filePath)
+
+    def openTextFile(self, filePath, encoding=None):
+        # Файлы, которые не стоит загружать в редактор целиком, открываются в окне просмотра
+        try:
+            if os.path.getsize(filePath) >= LARGE_TEXT_FILE_SIZE:
+                encoding = encoding or detectTextEncoding(filePath)
+                if LineIndex.supports(encoding):
+                    self.openTextViewer(filePath, encoding)
+                    return
+        except OSError as e:
+            QMessageBox.critical(self, "Ошибка", f"Не удалось открыть файл: {str(e)}")
+            return
+
+        self.startImport(TextImportThread(filePath, self.pageDocumentFactory(), encoding, self))
+
+    def openTextViewer(self, filePath, encoding):
+        try:
+            viewer = TextViewer(filePath, encoding, self)
+        except (OSError, ValueError) as e:
+            QMessageBox.critical(self, "Ошибка", f"Не удалось открыть файл: {str(e)}")
+            return
+        viewer.show()
+
+    def startImport(self, thread):
+        # Пока не пришла первая страница, в редакторе заглушка, а страницы не переключаются и не правятся;
+        # прежнее содержимое заменяется только с первой готовой страницей, так что ошибка разбора его не теряет
+        self.stopImport()
+        self.importThread = thread
+        self.importDelivered = False
+        thread.progress.connect(self.loadProgress.setValue)
+        thread.pageReady.connect(self.onImportPage)
+        thread.sourceReady.connect(self.onImportSource)
+        thread.finished.connect(self.onImportFinished)
+        self.loadPlaceholder = self.createPageDocument()
+        self.loadPlaceholder.setPlainText(f"Загрузка {os.path.basename(thread.filePath)}...")
+        self.textEdit.setDocument(self.loadPlaceholder)
+        self.matchHighlighter.documentChanged()
+        self.textEdit.setReadOnly(True)
+        self.pages.setEnabled(False)
+        self.loadProgress.setValue(0)
+        self.loadProgress.show()
+        self.loadCancelButton.show()
+        self.statusbar.showMessage(f"Загрузка {os.path.basename(thread.filePath)}...")
+        thread.start()
+
+    def cancelLoading(self):
+        # Поток прервётся у ближайшей проверки, итоги подведёт onImportFinished
+        if self.importThread is not None:
+            self.importThread.requestInterruption()
+
+    def stopImport(self):
+        # Прерываем загрузку и дожидаемся потока; его запоздалые сигналы отбрасываются
+        thread = self.importThread
+        if thread is None:
+            return
+        thread.requestInterruption()
+        thread.wait()
+        self.finishImport()
+        thread.deleteLater()
+
+    def finishImport(self):
+        self.importThread = None
+        self.loadPlaceholder = None
+        self.loadProgress.hide()
+        self.loadCancelButton.hide()
+        self.statusbar.clearMessage()
+        if not self.importDelivered:
+            self.load_page_content()
+            self.textEdit.setReadOnly(False)
+            self.pages.setEnabled(True)
+
+    def beginImportedPages(self):
+        if self.importDelivered:
+            return
+        self.importDelivered = True
+        if self.importThread.REPLACES_PAGES:
+            self.resetPages()
+            self.importFirstPage = 1
+        else:
+            self.importFirstPage = self.current_page
+        self.loadPlaceholder = None
+        self.textEdit.setReadOnly(False)
+        self.pages.setEnabled(True)
+
+    def takeImportedImages(self):
+        for key, data in list(self.importThread.images.blobs.items()):
+            if key not in self.images:
+                self.images.add(data)
+
+    def onImportPage(self, page, content):
+        if self.sender() is not self.importThread:
+            return
+        self.beginImportedPages()
+        self.takeImportedImages()
+        page += self.importFirstPage - 1
+        if isinstance(content, QTextDocument):
+            content.images = self.images
+            self.page_contents.replaceDocument(page, content)
+        else:
+            self.page_contents.putCompressed(page, *content)
+        self.pages.setMaximum(max(self.pages.maximum(), page))
+        if page == self.importFirstPage:
+            self.showPage(page)
+
+    def onImportSource(self, source):
+        if self.sender() is not self.importThread or self.importThread.isInterruptionRequested():
+            source.close()
+            return
+        self.beginImportedPages()
+        self.takeImportedImages()
+        self.page_contents.attachSource(source, self.importFirstPage)
+        self.pages.setMaximum(max(self.pages.maximum(), self.importFirstPage + source.pageCount - 1))
+        self.showPage(self.importFirstPage)
+
+    def onImportFinished(self):
+        thread = self.importThread
+        if self.sender() is not thread:
+            return
+        if self.importDelivered:
+            self.takeImportedImages()
+        self.finishImport()
+        thread.deleteLater()
+        if thread.error is not None:
+            QMessageBox.critical(self, "Ошибка", f"Не удалось открыть файл: {str(thread.error)}")
+        elif thread.cancelled:
+            # Уже полученные страницы остаются, недочитанный текстовый файл не подставляется
+            self.statusbar.showMessage("Загрузка отменена", 5000)
+
+    def openProject(self, filePath):
+        try:
+            project = ProjectFile(filePath)
+            styles = project.readStyles()
+        except (OSError, ValueError, struct.error, zlib.error) as e:
+            QMessageBox.critical(self, "Ошибка", f"Не удалось открыть проект: {str(e)}")
+            return
+
+        self.stopImport()
+        self.resetPages(project)
+        self.wordIndex.attach(project)
+
+        newStyles = {name: style for name, style in styles.items() if name not in self.styles}
+        if newStyles:
+            self.styles.update(newStyles)
+            self.saveStyles(self.styles)
+
+        self.pages.setMaximum(max(self.pages.maximum(), max(project.pages, default=1)))
+        self.showPage(min(project.pages, default=1))
+
+    def saveProject(self):
+        if self.page_contents.project is None:
+            self.saveProjectAs()
+        else:
+            self.writeProject(self.page_contents.project.path)
+
+    def saveProjectAs(self):
+        filePath, _ = QFileDialog.getSaveFileName(self, "Save Project", "",
+                                                  f"Project Files (*{ProjectFile.EXTENSION})")
         if filePath:
-            if filePath.endswith('.txt'):
-                with open(filePath, 'r') as file:
-                    data = file.read()
-                    self.textEdit.setPlainText(data)
-            elif filePath.endswith('.docx'):
-                self.openDocxFile(filePath)
-            elif filePath.endswith('.pdf'):
-                self.openPdfFile(filePath)
+            if not filePath.endswith(ProjectFile.EXTENSION):
+                filePath += ProjectFile.EXTENSION
+            self.writeProject(filePath)
+
+    def writeProject(self, filePath):
+        if self.page_contents.pending:
+            # Сохранение продолжится, когда оставшиеся страницы извлекутся в фоне
+            self.materializePages(partial(self.writeProject, filePath))
+            return
+        try:
+            previous = self.page_contents.project
+            samePath = previous is not None and previous.path == os.path.abspath(filePath)
+
+            # Блоки неизменённых страниц и уже сохранённые изображения переиспользуются
+            pages = {}
+            for page in self.page_contents.keys():
+                if samePath and page in previous.pages and page not in self.page_contents.dirty:
+                    pages[page] = None
+                else:
+                    pages[page] = self.page_contents.compressed(page)
+            images = {}
+            for key in self.images.keys():
+                images[key] = None if samePath and key in previous.images else self.images.data(key)
+
+            project = ProjectFile.save(filePath, pages, images, self.styles, previous)
+        except (OSError, struct.error) as e:
+            QMessageBox.critical(self, "Ошибка сохранения", f"Не удалось сохранить проект: {str(e)}")
+            return
+
+        self.page_contents.attachProject(project)
+        self.images.attachProject(project)
+        self.page_contents.markClean()
+        self.statusbar.showMessage(f"Проект сохранён: {filePath}", 5000)
+        try:
+            self.wordIndex.save(project)
+        except OSError:
+            pass  # без индекса поиск по всем страницам просто построит его заново
+
+    def resetPages(self, project=None):
+        self.stopMaterialize()
+        # Временный документ держит редактор, пока хранилище переключается на новое содержимое
+        placeholder = self.createPageDocument()
+        self.textEdit.setDocument(placeholder)
+        self.matchHighlighter.documentChanged()
+        self.page_contents.reset(project)
+        self.images.reset(project)
+        self.wordIndex.reset()
 
     def openDocxFile(self, filePath):
-        document = Document(filePath)
-        text = '\n'.join([paragraph.text for paragraph in document.paragraphs])
-        self.textEdit.setPlainText(text)
+        self.startImport(DocxImportThread(filePath, self.pageDocumentFactory(), self.importCache, self))
 
     def openPdfFile(self, filePath):
-        try:
-            doc = fitz.open(filePath)
-            text = ""
-            for page_num in range(doc.page_count):
-                page = doc.load_page(page_num)
-                text += page.get_text("text")
-            self.textEdit.setPlainText(text)
-        except Exception as e:
-            QMessageBox.critical(self, "Ошибка", f"Не удалось открыть файл PDF: {str(e)}")
+        self.startImport(PdfImportThread(filePath, self.pdfHtmlCache, self.importCache,
+                                         self.actionPdfFormatting.isChecked(), self))
 
     def printfile(self):
         printer = QPrinter(QPrinter.HighResolution)
@@ -588,22 +4067,12 @@ class MyWidget(QMainWindow):
         previewDialog.exec_()
 
     def printDocument(self, printer):
-        # Используйте QTextDocument для печати
-        document = QTextDocument()
+        # Печать всего документа постранично
+        printPages(printer, self.pageHtmls(), self.images)
 
-        # Объединяем содержимое всех страниц в один HTML документ
-        full_html = "<html><body>"
-        for page in sorted(self.page_contents.keys()):
-            text = self.page_contents.get(page, "")
-            if page != min(self.page_contents.keys()):  # Добавляем разрыв страницы между страницами
-                full_html += "<div style='page-break-before:always;'></div>"
-            full_html += f"<div>{text}</div>"
-        full_html += "</body></html>"
-
-        document.setHtml(full_html)
-
-        # Печать всего документа
-        document.print_(printer)
+    def pageHtmls(self):
+        for page in self.page_contents.keys():
+            yield self.page_contents.get(page, "")
 
     def exitEditor(self):
         result = QMessageBox.question(
@@ -762,9 +4231,55 @@ class MyWidget(QMainWindow):
             cursor.setBlockFormat(blockFormat)
             self.textEdit.setTextCursor(cursor)
 
+    def showMemoryStats(self):
+        stats = self.page_contents.pageStats()
+        hot = sum(1 for item in stats if item["state"] == "hot")
+        lines = []
+        for item in stats:
+            line = f"{item['page']}: {item['state']}"
+            if item["chars"] is not None:
+                line += f", {item['chars']} chars"
+            if item["stored"] is not None:
+                line += f", {item['raw']} -> {item['stored']} bytes"
+            if item["dirty"]:
+                line += ", modified"
+            lines.append(line)
+
+        box = QMessageBox(self)
+        box.setWindowTitle("Использование памяти")
+        box.setText(
+            f"Страниц: {len(stats)}, из них открытых документов: {hot}\n"
+            f"Сжатые страницы в памяти: {self.page_contents.coldBytes} байт "
+            f"(лимит {self.page_contents.memoryBudget})\n"
+            f"Сброшено во временный файл: {self.page_contents.spilledBytes()} байт\n"
+            f"Кэш импорта DOCX: попаданий {self.importCache.hits}, промахов {self.importCache.misses}\n"
+            f"Кэш страниц PDF: попаданий {self.pdfHtmlCache.hits}, промахов {self.pdfHtmlCache.misses}\n"
+            f"Кэш отрисовки PDF: попаданий {self.renderCache.hits}, промахов {self.renderCache.misses}"
+        )
+        box.setDetailedText("\n".join(lines))
+        box.exec_()
+
+    def closeEvent(self, event):
+        self.stopImport()
+        if self.findDialog is not None:
+            self.findDialog.close()
+        self.matchHighlighter.close()
+        for viewer in self.findChildren(TextViewer):
+            viewer.close()
+        if self.exportThread is not None and self.exportThread.isRunning():
+            self.exportThread.requestInterruption()
+            self.exportThread.wait()
+        self.stopMaterialize()
+        self.page_contents.close()
+        super().closeEvent(event)
+
     def findWindow(self):
-        self.dialog = FindDialog(self)
-        self.dialog.exec_()
+        # Окно поиска немодальное: с открытым окном можно листать подсвеченные совпадения и править текст
+        if self.findDialog is None:
+            self.findDialog = FindDialog(self)
+        self.findDialog.show()
+        self.findDialog.raise_()
+        self.findDialog.activateWindow()
     
     def replaceWindow(self):
         self.dialog = ReplaceDialog(self)
@@ -775,7 +4290,177 @@ class MyWidget(QMainWindow):
         self.dialog.exec_()
 
 
+def convertFile(inputPath, outputPath, outputFormat, workers=1, formatted=False):
+    # Выполняется в процессе-исполнителе: (файл, секунды, байт прочитано, ошибка)
+    started = time.perf_counter()
+    try:
+        fileFormat, encoding = detectFileFormat(inputPath)
+        if fileFormat not in ('text', 'docx', 'pdf'):
+            raise ValueError(f"неподдерживаемый формат {fileFormat or 'файла'}")
+        images = ImageStore()
+        if fileFormat == 'text':
+            text = readTextFile(inputPath, encoding)
+            htmls = [textToPageHtml(text)]
+        else:
+            htmls = readPages(inputPath, fileFormat, images, workers, formatted)
+            text = "\n".join(pageHtmlText(html) for html in htmls) if outputFormat == "txt" else None
+
+        fd, tempPath = tempfile.mkstemp(prefix=".", suffix="." + outputFormat,
+                                        dir=os.path.dirname(os.path.abspath(outputPath)))
+        os.close(fd)
+        try:
+            if outputFormat == "pdf":
+                printer = QPrinter(QPrinter.HighResolution)
+                printer.setOutputFormat(QPrinter.PdfFormat)
+                printer.setOutputFileName(tempPath)
+                printPages(printer, htmls, images)
+            elif outputFormat == "docx":
+                writeDocx(tempPath, htmls, images)
+            else:
+                with open(tempPath, "w", encoding="utf-8") as file:
+                    file.write(text)
+            replaceFile(tempPath, outputPath)
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+        return inputPath, time.perf_counter() - started, os.path.getsize(inputPath), None
+    except Exception as e:
+        return inputPath, time.perf_counter() - started, 0, str(e)
+
+
+def collectInputs(patterns, listFile):
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        paths.extend(matches if matches else [pattern])
+    if listFile:
+        with (sys.stdin if listFile == "-" else open(listFile, encoding="utf-8")) as file:
+            paths.extend(line.strip() for line in file if line.strip())
+    # Один файл, указанный разными путями, конвертируется один раз
+    files = {}
+    for path in dict.fromkeys(paths):
+        if os.path.isfile(path):
+            files.setdefault(os.path.realpath(path), path)
+        else:
+            print(f"skip {path}: not a file", file=sys.stderr)
+    return list(files.values())
+
+
+def outputPaths(paths, outputDir, outputFormat):
+    # Обычно результат — имя входного файла с новым расширением. Совпавшие имена разводятся
+    # сначала по путям относительно общего каталога входных файлов, затем по исходным расширениям
+    baseDir = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+
+    def outputPath(path, keepDir=False, keepExtension=False):
+        name = os.path.basename(path)
+        if not keepExtension:
+            name = os.path.splitext(name)[0]
+        relativeDir = os.path.relpath(os.path.dirname(os.path.abspath(path)), baseDir) if keepDir else ""
+        return os.path.normpath(os.path.join(outputDir, relativeDir, name + "." + outputFormat))
+
+    targets = [outputPath(path) for path in paths]
+    for keepExtension in (False, True):
+        counts = {}
+        for target in targets:
+            counts[target] = counts.get(target, 0) + 1
+        targets = [outputPath(path, True, keepExtension) if counts[target] > 1 else target
+                   for path, target in zip(paths, targets)]
+    return targets
+
+
+def convertFiles(paths, outputDir, outputFormat, workers, formatted=False):
+    targets = outputPaths(paths, outputDir, outputFormat)
+    # Два входных файла не должны писать в один результат, а результат — заменять входной файл
+    inputs = {os.path.realpath(path) for path in paths}
+    seen = set()
+    for path, target in zip(paths, targets):
+        realTarget = os.path.realpath(target)
+        if realTarget in inputs:
+            print(f"error: {path}: output {target} would overwrite an input file", file=sys.stderr)
+            return 2
+        if realTarget in seen:
+            print(f"error: {path}: output {target} is already produced by another input", file=sys.stderr)
+            return 2
+        seen.add(realTarget)
+
+    for target in targets:
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    jobs = list(zip(paths, targets))
+    started = time.perf_counter()
+    results = []
+
+    def report(result):
+        path, seconds, size, error = result
+        results.append(result)
+        # Ошибки идут в stderr, чтобы их не терял вывод, перенаправленный в файл или конвейер
+        status = f"error: {error}" if error else f"{size / 1024:.0f} KiB"
+        print(f"{seconds:8.3f} s  {path}  {status}", file=sys.stderr if error else sys.stdout, flush=True)
+
+    if workers <= 1 or len(jobs) < 2:
+        # Один файл: процессы достаются извлечению текста из его страниц
+        for job in jobs:
+            report(convertFile(job[0], job[1], outputFormat, workers, formatted))
+    else:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=initRenderProcess) as executor:
+            futures = [executor.submit(convertFile, inputPath, outputPath, outputFormat, 1, formatted)
+                       for inputPath, outputPath in jobs]
+            for future in as_completed(futures):
+                report(future.result())
+
+    elapsed = time.perf_counter() - started
+    failed = sum(1 for result in results if result[3])
+    totalBytes = sum(result[2] for result in results)
+    print(f"{len(results) - failed} converted, {failed} failed in {elapsed:.2f} s: "
+          f"{len(results) / elapsed if elapsed else 0:.1f} files/s, "
+          f"{totalBytes / 1024 / 1024 / elapsed if elapsed else 0:.2f} MiB/s")
+    return 1 if failed else 0
+
+
+COMMANDS = ("convert", "benchmark")
+
+
+def runCommandLine(argv):
+    parser = argparse.ArgumentParser(prog="main_summer_practice.py",
+                                     description="Headless conversion and benchmarks without opening the editor window")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert = commands.add_parser("convert", help="convert .txt/.docx/.pdf files to pdf, docx or txt")
+    convert.add_argument("inputs", nargs="*", help="files or glob patterns")
+    convert.add_argument("--list", dest="listFile", help="file with one input path per line, '-' for stdin")
+    convert.add_argument("-o", "--output-dir", required=True)
+    convert.add_argument("-f", "--format", default="pdf", choices=["pdf", "docx", "txt"])
+    convert.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1)
+    convert.add_argument("--keep-pdf-formatting", dest="formatted", action="store_true",
+                         help="keep fonts and styles of PDF text, as the Keep PDF Formatting option")
+
+    benchmark = commands.add_parser("benchmark", help="measure export/import throughput")
+    benchmark.add_argument("target", choices=["export", "docx-export", "pdf-extract"])
+    benchmark.add_argument("--pages", type=int, default=300)
+    benchmark.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1)
+
+    args = parser.parse_args(argv)
+    os.environ["QT_QPA_PLATFORM"] = "offscreen"
+    app = QGuiApplication([sys.argv[0]])
+
+    if args.command == "convert":
+        paths = collectInputs(args.inputs, args.listFile)
+        if not paths:
+            parser.error("no input files")
+        return convertFiles(paths, args.output_dir, args.format, args.workers, args.formatted)
+    if args.target == "export":
+        benchmarkPdfExport(args.pages, args.workers)
+    elif args.target == "docx-export":
+        benchmarkDocxExport(args.pages)
+    elif args.target == "pdf-extract":
+        benchmarkPdfExtract(args.pages, args.workers)
+    return 0
+
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(runCommandLine(sys.argv[1:]))
+
     app = QApplication(sys.argv)
     window = MyWidget()
     window.show()
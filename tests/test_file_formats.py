@@ -0,0 +1,88 @@
+import os
+import sys
+import tempfile
+import unittest
+
+from docx import Document
+# main_summer_practice импортирует ресурсы как summer_practice.res_rc: нужен каталог над репозиторием
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtWidgets import QApplication
+
+app = QApplication.instance() or QApplication([sys.argv[0]])
+
+import main_summer_practice as m
+
+
+class DetectFileFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def detect(self, data):
+        path = os.path.join(self.directory.name, "sample")
+        with open(path, "wb") as file:
+            file.write(data)
+        return m.detectFileFormat(path)[0]
+
+    def test_pdf_header(self):
+        self.assertEqual(self.detect(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n1 0 obj"), "pdf")
+        self.assertEqual(self.detect(b"\r\n  %PDF-1.4\n"), "pdf")
+        self.assertEqual(self.detect(b"\xef\xbb\xbf%PDF-1.4\n"), "pdf")
+
+    def test_text_mentioning_pdf_header_is_text(self):
+        self.assertEqual(self.detect(b"Notes: files start with %PDF-1.7, see the spec.\n"), "text")
+        self.assertEqual(self.detect(b"# %PDF-1.7\n"), "text")
+
+    def test_other_formats(self):
+        self.assertEqual(self.detect(m.ProjectFile.MAGIC + bytes(28)), "project")
+        self.assertEqual(self.detect("юникод\n".encode("utf-8")), "text")
+        self.assertIsNone(self.detect(b"\x00\x01\x02binary"))
+
+
+class DocxExportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "out.docx")
+        self.images = m.ImageStore()
+
+    def export(self, *pages):
+        m.writeDocx(self.path, list(pages), self.images)
+        return Document(self.path)
+
+    def test_table_is_exported_as_table(self):
+        output = self.export("<p>before</p><table border=\"1\"><tr><td>a1</td><td>b1</td></tr>"
+                             "<tr><td>a2</td><td>b2</td></tr></table><p>after</p>")
+        self.assertEqual(len(output.tables), 1)
+        self.assertEqual([cell.text for cell in output.tables[0]._cells], ["a1", "b1", "a2", "b2"])
+        self.assertNotIn("a1", [paragraph.text for paragraph in output.paragraphs])
+
+    def test_merged_and_nested_cells_round_trip(self):
+        self.export("<table border=\"1\"><tr><td colspan=\"2\">wide</td><td rowspan=\"2\">tall</td></tr>"
+                    "<tr><td>c</td><td><table><tr><td>inner</td></tr></table></td></tr></table>")
+        reader = m.DocxReader(self.path, lambda: m.PageDocument(self.images), self.images)
+        page, = reader.pages()
+        cursor = m.QTextCursor(page)
+        self.assertTrue(cursor.movePosition(m.QTextCursor.NextBlock))
+        table = cursor.currentTable()
+        self.assertEqual((table.rows(), table.columns()), (2, 3))
+        self.assertEqual(table.cellAt(0, 0).columnSpan(), 2)
+        self.assertEqual(table.cellAt(0, 2).rowSpan(), 2)
+        self.assertIn("inner", page.toPlainText())
+
+    def test_links_are_exported_as_hyperlinks(self):
+        output = self.export("<p>see <a href=\"https://example.com/\">the <b>site</b></a> "
+                             "and <a href=\"#top\">top</a></p>")
+        links = output.element.body.findall(".//" + m.qn("w:hyperlink"))
+        self.assertEqual(len(links), 2)
+        self.assertEqual(output.part.rels[links[0].get(m.qn("r:id"))].target_ref, "https://example.com/")
+        self.assertEqual("".join(text.text for text in links[0].iter(m.qn("w:t"))), "the site")
+        self.assertEqual(links[1].get(m.qn("w:anchor")), "top")
+
+
+if __name__ == "__main__":
+    unittest.main()
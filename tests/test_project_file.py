@@ -0,0 +1,229 @@
+import os
+import sys
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+# main_summer_practice импортирует ресурсы как summer_practice.res_rc: нужен каталог над репозиторием
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtWidgets import QApplication
+
+app = QApplication.instance() or QApplication([sys.argv[0]])
+
+import main_summer_practice as m
+
+
+def pageBlock(text):
+    data = text.encode("utf-8")
+    return zlib.compress(data), len(data)
+
+
+def pageText(project, page):
+    offset, length, _ = project.pages[page]
+    return zlib.decompress(project.read(offset, length)).decode("utf-8")
+
+
+class ProjectFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "book.sprj")
+        self.projects = []
+
+    def tearDown(self):
+        for project in self.projects:
+            project.close()
+        self.directory.cleanup()
+
+    def save(self, pages, images=None, previous=None, path=None):
+        project = m.ProjectFile.save(path or self.path, pages, images or {}, {"style": {}}, previous)
+        self.projects.append(project)
+        return project
+
+    def test_new_project_round_trip(self):
+        pages = {page: pageBlock(f"page {page}") for page in (1, 2, 3)}
+        self.save(pages, {"a" * 40: b"image"})
+
+        project = m.ProjectFile(self.path)
+        self.projects.append(project)
+        self.assertEqual(sorted(project.pages), [1, 2, 3])
+        self.assertEqual(pageText(project, 2), "page 2")
+        self.assertEqual(project.read(*project.images["a" * 40]), b"image")
+        self.assertEqual(project.readStyles(), {"style": {}})
+
+    def test_unchanged_save_returns_previous(self):
+        first = self.save({1: pageBlock("one")})
+        self.assertIs(self.save({1: None}, previous=first), first)
+
+    def test_append_writes_only_changed_blocks(self):
+        first = self.save({page: pageBlock(f"page {page}" * 50) for page in (1, 2, 3)})
+        entries = dict(first.pages)
+        size = first.size
+
+        second = self.save({1: None, 2: pageBlock("edited"), 3: None}, previous=first)
+        self.assertIsNone(first.map)
+        self.assertEqual(second.pages[1], entries[1])
+        self.assertEqual(second.pages[3], entries[3])
+        self.assertGreaterEqual(second.pages[2][0], size)
+
+        reopened = m.ProjectFile(self.path)
+        self.projects.append(reopened)
+        self.assertEqual(pageText(reopened, 1), "page 1" * 50)
+        self.assertEqual(pageText(reopened, 2), "edited")
+
+    def test_rewrite_compacts_dead_blocks(self):
+        project = self.save({1: pageBlock("keep"), 2: pageBlock("x")})
+        sizes = []
+        for version in range(8):
+            project = self.save({1: None, 2: pageBlock(os.urandom(2000).hex() + str(version))}, previous=project)
+            sizes.append(project.size)
+        # Когда живых байт меньше половины файла, файл переписывается заново и уменьшается
+        self.assertTrue(any(later < earlier for earlier, later in zip(sizes, sizes[1:])))
+        self.assertEqual(pageText(project, 1), "keep")
+        self.assertTrue(pageText(project, 2).endswith("7"))
+
+    def test_new_file_gets_umask_permissions(self):
+        self.save({1: pageBlock("one")})
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o666 & ~m.UMASK)
+
+    def test_failed_save_as_keeps_previous_open(self):
+        first = self.save({1: pageBlock("one"), 2: pageBlock("two")})
+        target = os.path.join(self.directory.name, "copy.sprj")
+        with mock.patch.object(m, "replaceFile", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.save({1: pageBlock("one"), 2: pageBlock("two")}, previous=first, path=target)
+        self.assertFalse(os.path.exists(target))
+        self.assertEqual(os.listdir(self.directory.name), ["book.sprj"])
+        self.assertEqual(pageText(first, 2), "two")
+
+    def test_failed_append_keeps_previous_open(self):
+        first = self.save({1: pageBlock("one")})
+        with mock.patch.object(m.ProjectFile, "append", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.save({1: pageBlock("changed")}, previous=first)
+        self.assertEqual(pageText(first, 1), "one")
+
+
+class WordIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "book.sprj")
+        self.images = m.ImageStore()
+        self.pageStore, self.wordIndex = self.createStores()
+        for page in range(1, 6):
+            self.pageStore[page] = m.textToPageHtml(f"page{page} alpha beta\nfoo_bar gamma {page}")
+
+    def tearDown(self):
+        if self.pageStore.project is not None:
+            self.pageStore.project.close()
+        self.directory.cleanup()
+
+    def createStores(self):
+        pageStore = m.PageStore(lambda: m.PageDocument(self.images))
+        return pageStore, m.WordIndex(pageStore)
+
+    def writeProject(self, pageStore, wordIndex):
+        # Как MyWidget.writeProject: неизменённые страницы уже лежат в файле проекта
+        previous = pageStore.project
+        pages = {page: None if previous is not None and page in previous.pages and page not in pageStore.dirty
+                 else pageStore.compressed(page) for page in pageStore.keys()}
+        project = m.ProjectFile.save(self.path, pages, {}, {}, previous)
+        pageStore.attachProject(project)
+        pageStore.markClean()
+        wordIndex.save(project)
+        return project
+
+    def openProject(self):
+        pageStore, wordIndex = self.createStores()
+        project = m.ProjectFile(self.path)
+        pageStore.reset(project)
+        wordIndex.attach(project)
+        self.addCleanup(project.close)
+        return pageStore, wordIndex
+
+    def test_index_round_trip_after_one_page_edit(self):
+        self.assertEqual(len(self.wordIndex.find("alpha")), 5)
+        self.writeProject(self.pageStore, self.wordIndex)
+        indexPath = self.path + m.WordIndex.SUFFIX
+        stored = dict(self.wordIndex.stored)
+        size = os.path.getsize(indexPath)
+
+        self.pageStore[3] = m.textToPageHtml("zebra alpha")
+        self.wordIndex.refresh()
+        self.writeProject(self.pageStore, self.wordIndex)
+        # Дописан только блок изменённой страницы
+        self.assertGreater(os.path.getsize(indexPath), size)
+        for page in (1, 2, 4, 5):
+            self.assertEqual(self.wordIndex.stored[page], stored[page])
+        self.assertGreaterEqual(self.wordIndex.stored[3][3], size)
+
+        pageStore, wordIndex = self.openProject()
+        self.assertEqual(wordIndex.pageWords, {})
+        wordIndex.loadStored()
+        self.assertEqual(sorted(wordIndex.pageWords), [1, 2, 3, 4, 5])
+        self.assertEqual(pageStore.plainTexts, {})
+        self.assertEqual(wordIndex.find("zebra"), [(3, 0, 5)])
+        self.assertEqual(len(wordIndex.find("alpha")), 5)
+
+    def test_edited_page_is_not_taken_from_index(self):
+        self.wordIndex.refresh()
+        self.writeProject(self.pageStore, self.wordIndex)
+
+        pageStore, wordIndex = self.openProject()
+        pageStore[2] = m.textToPageHtml("yak")
+        self.assertEqual(wordIndex.find("yak"), [(2, 0, 3)])
+        self.assertEqual([hit[0] for hit in wordIndex.find("alpha")], [1, 3, 4, 5])
+
+    def test_prefix_hits_match_page_scan(self):
+        regex = m.searchPattern("alp", prefix=True)
+        scanned = [(page,) + match.span() for page in self.pageStore.keys()
+                   for match in regex.finditer(self.pageStore.plainText(page))]
+        self.assertEqual(self.wordIndex.find("alp", prefix=True), scanned)
+
+    def test_damaged_index_is_rebuilt(self):
+        self.wordIndex.refresh()
+        self.writeProject(self.pageStore, self.wordIndex)
+        with open(self.path + m.WordIndex.SUFFIX, "wb") as file:
+            file.write(b"garbage" * 10)
+
+        pageStore, wordIndex = self.openProject()
+        self.assertEqual(len(wordIndex.find("gamma")), 5)
+        self.assertEqual(len(pageStore.plainTexts), 5)
+
+
+class MainWindowSaveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(ROOT)  # окно загружает main_practice_summer.ui из текущего каталога
+        self.window = m.MyWidget()
+
+    def tearDown(self):
+        self.window.close()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_failed_save_as_keeps_pages_readable(self):
+        path = os.path.join(self.directory.name, "book.sprj")
+        for page in (1, 2, 3):
+            self.window.page_contents[page] = m.textToPageHtml(f"page {page}")
+        self.window.writeProject(path)
+        self.window.openProject(path)
+
+        target = os.path.join(self.directory.name, "copy.sprj")
+        with mock.patch.object(m, "replaceFile", side_effect=OSError("disk full")), \
+                mock.patch.object(m.QMessageBox, "critical") as critical:
+            self.window.writeProject(target)
+        critical.assert_called_once()
+        self.assertFalse(os.path.exists(target))
+        self.assertEqual(m.pageHtmlText(self.window.page_contents.html(2)), "page 2")
+        self.window.showPage(3)
+        self.assertEqual(self.window.textEdit.toPlainText(), "page 3")
+
+
+if __name__ == "__main__":
+    unittest.main()